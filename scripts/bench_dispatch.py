@@ -0,0 +1,56 @@
+"""Dispatch overhead of function_call, before and after the precomputed schema registry.
+
+The OpenAI call is replaced by a stub that encodes the request body like the client does and
+answers with plain content, so only the work done around the request is measured.
+
+    python -m scripts.bench_dispatch --calls 2000 --subset BlogPostWebPage,IngestSiteMap
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import openai
+from aiofauna.llm.llm import function_call as aiofauna_function_call
+
+from src.helpers.llm import function_call
+from src.helpers.registry import functions_registry, requested_functions
+
+RESPONSE = {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+
+async def stub_acreate(**kwargs):
+    json.dumps(kwargs)
+    return RESPONSE
+
+
+async def measure(name: str, calls: int, factory) -> None:
+    start = time.perf_counter()
+    for _ in range(calls):
+        await factory()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>28}: {elapsed / calls * 1e6:8.1f}us per call")
+
+
+async def main(calls: int, subset: str) -> None:
+    openai.ChatCompletion.acreate = stub_acreate  # type: ignore
+    everything = functions_registry.build()
+    selected = functions_registry.subset(*requested_functions(subset))
+    print(f"all functions: {len(everything)} specs, {everything.tokens} tokens")
+    print(f"subset: {len(selected)} specs, {selected.tokens} tokens")
+
+    await measure("aiofauna function_call", calls, lambda: aiofauna_function_call("hello"))
+    await measure("registry function_call (all)", calls, lambda: function_call("hello"))
+    await measure(
+        "registry function_call (subset)",
+        calls,
+        lambda: function_call("hello", functions=selected),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--subset", default="BlogPostWebPage,IngestSiteMap")
+    args = parser.parse_args()
+    asyncio.run(main(args.calls, args.subset))
@@ -0,0 +1,71 @@
+"""Publish-to-receive latency and delivery throughput of the pub/sub brokers.
+
+Every subscriber is a client queue on one channel, drained by its own task, as the SSE
+handlers do. `memory` needs no Redis server; `pubsub` and `streams` use REDIS_URL.
+
+    python -m scripts.bench_fanout --broker memory --subscribers 1 100 10000
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+from src.services.pubsub import Broker, create_broker
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run(broker: Broker, subscribers: int, messages: int, rate: float) -> None:
+    channel = f"bench:fanout:{subscribers}"
+    latencies: List[float] = []
+    done = asyncio.Event()
+    expected = subscribers * messages
+
+    async def drain(queue: "asyncio.Queue"):
+        for _ in range(messages):
+            _, data = await queue.get()
+            latencies.append(time.perf_counter() - float(data))
+            if len(latencies) == expected:
+                done.set()
+
+    queues = [await broker.subscribe(channel) for _ in range(subscribers)]
+    tasks = [asyncio.create_task(drain(queue)) for queue in queues]
+    start = time.perf_counter()
+    for _ in range(messages):
+        await broker.publish(channel, repr(time.perf_counter()))
+        if rate:
+            await asyncio.sleep(1 / rate)
+    await asyncio.wait_for(done.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+    for queue in queues:
+        await broker.unsubscribe(channel, queue)
+    for task in tasks:
+        task.cancel()
+
+    latencies.sort()
+    print(
+        f"{broker.name:>12} subscribers={subscribers:<6} "
+        f"p50={percentile(latencies, 0.50) * 1e3:8.2f}ms "
+        f"p95={percentile(latencies, 0.95) * 1e3:8.2f}ms "
+        f"p99={percentile(latencies, 0.99) * 1e3:8.2f}ms "
+        f"max={latencies[-1] * 1e3:8.2f}ms "
+        f"throughput={expected / elapsed:10.0f} deliveries/s"
+    )
+
+
+async def main(backend: str, subscribers: List[int], messages: int, rate: float) -> None:
+    broker = create_broker(backend)
+    for count in subscribers:
+        await run(broker, count, messages, rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--broker", default="memory", choices=["memory", "pubsub", "streams"])
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 100, 10000])
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 publishes back to back")
+    args = parser.parse_args()
+    asyncio.run(main(args.broker, args.subscribers, args.messages, args.rate))
@@ -0,0 +1,53 @@
+"""Per-message publish latency of FunctionQueue.publish against publish_many.
+
+Runs against the Redis server in REDIS_URL with the app's .env loaded:
+
+    python -m scripts.bench_publish --messages 10000 --batch 100
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from src.services.pubsub import FunctionQueue
+
+
+def report(name: str, samples: list, messages: int, elapsed: float):
+    samples = sorted(samples)
+    print(
+        f"{name:>14}: {messages / elapsed:10.0f} msg/s "
+        f"p50={samples[len(samples) // 2] * 1e6:8.1f}us "
+        f"p99={samples[int(len(samples) * 0.99)] * 1e6:8.1f}us "
+        f"mean={statistics.mean(samples) * 1e6:8.1f}us per message"
+    )
+
+
+async def main(messages: int, batch: int, namespace: str):
+    queue = FunctionQueue(namespace=namespace)
+    payload = json.dumps({"response": "x" * 256, "type": "str"})
+
+    samples = []
+    start = time.perf_counter()
+    for _ in range(messages):
+        sent = time.perf_counter()
+        await queue.publish(payload)
+        samples.append(time.perf_counter() - sent)
+    report("publish", samples, messages, time.perf_counter() - start)
+
+    samples = []
+    start = time.perf_counter()
+    for _ in range(0, messages, batch):
+        sent = time.perf_counter()
+        await queue.publish_many([payload] * batch)
+        samples.extend([(time.perf_counter() - sent) / batch] * batch)
+    report(f"publish_many/{batch}", samples, messages, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=100)
+    parser.add_argument("--namespace", default="bench:publish")
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.batch, args.namespace))
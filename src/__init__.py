@@ -1,5 +1,12 @@
+import asyncio
+
 from aiofauna import APIServer
 
+from .config import env
+from .helpers.background import jobs
+from .helpers.metrics import watch_loop
+from .helpers.persistence import write_behind
+from .helpers.registry import functions_registry
 from .routes import *
 
 
@@ -8,4 +15,32 @@ def create_app():
 
     app = use_chat(use_auto(use_zaps(_)))
 
+    async def flush_writes(_):
+        await write_behind.close(env.WRITE_BEHIND_CLOSE_TIMEOUT)
+
+    async def start_jobs(_):
+        jobs.start()
+
+    async def build_functions(_):
+        functions_registry.build()
+
+    async def stop_jobs(_):
+        await jobs.close()
+
+    async def start_loop_watch(app):
+        app["loop_watch"] = asyncio.create_task(
+            watch_loop(threshold=env.LOOP_STALL_THRESHOLD)
+        )
+
+    async def stop_loop_watch(app):
+        app["loop_watch"].cancel()
+
+    app.on_startup.append(build_functions)
+    app.on_startup.append(start_jobs)
+    app.on_startup.append(start_loop_watch)
+    # Runs ahead of the APIServer shutdown hook, which closes the Fauna session
+    app.on_shutdown.insert(0, flush_writes)
+    app.on_shutdown.insert(0, stop_jobs)
+    app.on_shutdown.append(stop_loop_watch)
+
     return app
@@ -1,5 +1,6 @@
 import base64
 import json
+from typing import Optional
 
 from aiofauna import Field as Data
 from dotenv import load_dotenv
@@ -68,6 +69,56 @@ class Env(BaseSettings):
     IP_ADDR: str = Data(..., env="IP_ADDR")
     CLIENT_URL: str = Data(..., env="CLIENT_URL")
     REDIS_URL: str = Data(..., env="REDIS_URL")
+    PAGE_SIZE_MAX: int = Data(default=500, env="PAGE_SIZE_MAX")
+    WRITE_BEHIND_QUEUE_SIZE: int = Data(default=1024, env="WRITE_BEHIND_QUEUE_SIZE")
+    WRITE_BEHIND_BATCH_SIZE: int = Data(default=32, env="WRITE_BEHIND_BATCH_SIZE")
+    WRITE_BEHIND_CLOSE_TIMEOUT: float = Data(default=10, env="WRITE_BEHIND_CLOSE_TIMEOUT")
+    CONTEXT_CACHE_SIZE: int = Data(default=1024, env="CONTEXT_CACHE_SIZE")
+    CONTEXT_CACHE_TTL: float = Data(default=900, env="CONTEXT_CACHE_TTL")
+    CONTEXT_WINDOW: int = Data(default=32, env="CONTEXT_WINDOW")
+    CONTEXT_TOKEN_BUDGET: int = Data(default=2048, env="CONTEXT_TOKEN_BUDGET")
+    RENDER_CACHE_SIZE: int = Data(default=4096, env="RENDER_CACHE_SIZE")
+    RENDER_CACHE_TTL: float = Data(default=604800, env="RENDER_CACHE_TTL")
+    POLLY_WORKERS: int = Data(default=8, env="POLLY_WORKERS")
+    POLLY_PIPELINE_WORKERS: int = Data(default=4, env="POLLY_PIPELINE_WORKERS")
+    POLLY_CACHE_DIR: str = Data(default="/tmp/polly", env="POLLY_CACHE_DIR")
+    POLLY_CACHE_MAX_BYTES: int = Data(default=256 * 1024 * 1024, env="POLLY_CACHE_MAX_BYTES")
+    POLLY_CACHE_BUCKET: Optional[str] = Data(default=None, env="POLLY_CACHE_BUCKET")
+    WS_QUEUE_SIZE: int = Data(default=256, env="WS_QUEUE_SIZE")
+    WS_OVERFLOW: str = Data(default="drop", env="WS_OVERFLOW")
+    WS_HEARTBEAT: float = Data(default=20, env="WS_HEARTBEAT")
+    WS_TURN_LEASE: float = Data(default=30, env="WS_TURN_LEASE")
+    SEMANTIC_CACHE_SCOPE: Optional[str] = Data(default=None, env="SEMANTIC_CACHE_SCOPE")
+    SEMANTIC_CACHE_THRESHOLD: float = Data(default=0.95, env="SEMANTIC_CACHE_THRESHOLD")
+    SEMANTIC_CACHE_SIZE: int = Data(default=1024, env="SEMANTIC_CACHE_SIZE")
+    SEMANTIC_CACHE_TTL: float = Data(default=3600, env="SEMANTIC_CACHE_TTL")
+    SEMANTIC_CACHE_SCOPES: int = Data(default=4096, env="SEMANTIC_CACHE_SCOPES")
+    AUTH0_AUDIENCE: Optional[str] = Data(default=None, env="AUTH0_AUDIENCE")
+    AUTH_CACHE_SIZE: int = Data(default=4096, env="AUTH_CACHE_SIZE")
+    AUTH_CACHE_TTL: float = Data(default=300, env="AUTH_CACHE_TTL")
+    JWKS_REFRESH_INTERVAL: float = Data(default=3600, env="JWKS_REFRESH_INTERVAL")
+    FUNCTION_QUEUE_BACKEND: str = Data(default="pubsub", env="FUNCTION_QUEUE_BACKEND")
+    FUNCTION_QUEUE_SIZE: int = Data(default=256, env="FUNCTION_QUEUE_SIZE")
+    FUNCTION_STREAM_MAXLEN: int = Data(default=1000, env="FUNCTION_STREAM_MAXLEN")
+    FUNCTION_STREAM_CLAIM_IDLE: float = Data(default=60, env="FUNCTION_STREAM_CLAIM_IDLE")
+    SSE_QUEUE_SIZE: int = Data(default=256, env="SSE_QUEUE_SIZE")
+    SSE_OVERFLOW: str = Data(default="drop", env="SSE_OVERFLOW")
+    SSE_KEEPALIVE: float = Data(default=15, env="SSE_KEEPALIVE")
+    SSE_SEND_TIMEOUT: float = Data(default=10, env="SSE_SEND_TIMEOUT")
+    JOB_BACKEND: str = Data(default="local", env="JOB_BACKEND")
+    JOB_CONCURRENCY: int = Data(default=8, env="JOB_CONCURRENCY")
+    JOB_RETRIES: int = Data(default=2, env="JOB_RETRIES")
+    JOB_TIMEOUT: float = Data(default=300, env="JOB_TIMEOUT")
+    JOB_INGEST_TIMEOUT: float = Data(default=3600, env="JOB_INGEST_TIMEOUT")
+    JOB_RESULT_TTL: float = Data(default=86400, env="JOB_RESULT_TTL")
+    BACKGROUND_THREADS: int = Data(default=8, env="BACKGROUND_THREADS")
+    PLAN_CONCURRENCY: int = Data(default=16, env="PLAN_CONCURRENCY")
+    S3_THREADS: int = Data(default=8, env="S3_THREADS")
+    S3_PART_SIZE: int = Data(default=8 * 1024 * 1024, env="S3_PART_SIZE")
+    S3_MAX_PARTS: int = Data(default=4, env="S3_MAX_PARTS")
+    S3_PRESIGN_EXPIRES: int = Data(default=3600, env="S3_PRESIGN_EXPIRES")
+    LOOP_STALL_THRESHOLD: float = Data(default=0.1, env="LOOP_STALL_THRESHOLD")
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
@@ -2,3 +2,5 @@ from .formaters import *
 from .loaders import *
 from .utils import *
 from .background import *
+from .metrics import *
+from .llm import *
@@ -1,12 +1,425 @@
+import asyncio
 import functools
-from celery import Celery
+import itertools
+import time
+from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import aioredis
+from aiofauna.utils import setup_logging
+from pydantic import BaseModel, Field
+
 from ..config import env
+from .connections import pool
+from .metrics import metrics
+
+logger = setup_logging(__name__)
+
+job_registry: Dict[str, Callable[..., Awaitable[Any]]] = {}
+
+FINISHED = ("succeeded", "failed")
+
+# Only the most recent partial results are kept so a status read stays one small key
+MAX_PARTIALS = 20
+
+
+class Job(BaseModel):
+    """A registered function call waiting to run, lower priorities run first"""
+
+    id: str = Field(default_factory=lambda: uuid4().hex)
+    name: str = Field(...)
+    args: List[Any] = Field(default_factory=list)
+    kwargs: Dict[str, Any] = Field(default_factory=dict)
+    priority: int = Field(default=0)
+    retries: int = Field(default=0)
+    timeout: float = Field(default=300)
+    backoff: float = Field(default=1.0)
+    attempt: int = Field(default=0)
+
+
+class JobResult(BaseModel):
+    """Stored state of a job"""
+
+    id: str = Field(...)
+    name: str = Field(...)
+    status: str = Field(default="queued")
+    attempt: int = Field(default=0)
+    progress: Optional[float] = Field(default=None)
+    message: Optional[str] = Field(default=None)
+    partial: List[Any] = Field(default_factory=list)
+    result: Any = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    started: Optional[float] = Field(default=None)
+    finished: Optional[float] = Field(default=None)
+
+
+current_job: "ContextVar[Optional[Tuple[JobRunner, JobResult]]]" = ContextVar("current_job", default=None)
+
+
+async def report_progress(
+    progress: Optional[float] = None, message: Optional[str] = None, partial: Any = None
+):
+    """Records progress on the job running in this context, does nothing outside of a job"""
+    running = current_job.get()
+    if running is None:
+        return
+    runner, state = running
+    if progress is not None:
+        state.progress = progress
+    if message is not None:
+        state.message = message
+    if partial is not None:
+        state.partial = [*state.partial, partial][-MAX_PARTIALS:]
+    try:
+        await runner.store(state)
+    except (aioredis.RedisError, OSError) as exc:
+        # Progress is best effort, the job itself keeps running
+        logger.warning(f"Could not store the progress of job {state.id}: {exc}")
+
+
+class JobRunner(ABC):
+    """Runs registered jobs with bounded concurrency, retries with exponential backoff and timeouts.
+
+    Job states are kept under `job:{id}` in Redis for JOB_RESULT_TTL seconds.
+    """
+
+    def __init__(self, concurrency: int = 8, ttl: float = 86400):
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.workers: List["asyncio.Task[None]"] = []
+        self.running = 0
+        self.pending: List[Job] = []
+
+    def start(self):
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self._work()) for _ in range(self.concurrency)
+            ]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submit(self, job: Job) -> str:
+        await self.store(JobResult(id=job.id, name=job.name))
+        await self._push(job)
+        metrics.incr(f"jobs.{job.name}.submitted")
+        self.start()
+        return job.id
+
+    async def store(self, state: JobResult):
+        try:
+            payload = state.json(exclude_defaults=True)
+        except TypeError:
+            payload = state.copy(
+                update={"result": repr(state.result), "partial": [repr(item) for item in state.partial]}
+            ).json(exclude_defaults=True)
+        await pool.set(f"job:{state.id}", payload, ex=int(self.ttl))
+
+    async def result(self, job_id: str) -> Optional[JobResult]:
+        payload = await pool.get(f"job:{job_id}")
+        if payload is None:
+            return None
+        return JobResult.parse_raw(payload)
+
+    async def watch(self, job_id: str, interval: float = 0.5) -> AsyncGenerator[str, None]:
+        """Yields the stored state whenever it changes, until the job finishes or expires"""
+        last = None
+        while True:
+            payload = await pool.get(f"job:{job_id}")
+            if payload is None:
+                return
+            if payload != last:
+                last = payload
+                yield payload.decode("utf-8")
+                if JobResult.parse_raw(payload).status in FINISHED:
+                    return
+            await asyncio.sleep(interval)
+
+    async def execute(self, job: Job):
+        state = JobResult(id=job.id, name=job.name, attempt=job.attempt, status="running", started=time.time())
+        await self.store(state)
+        self.running += 1
+        started = time.perf_counter()
+        token = current_job.set((self, state))
+        try:
+            state.result = await asyncio.wait_for(
+                job_registry[job.name](*job.args, **job.kwargs), job.timeout
+            )
+            state.progress = 1.0
+            state.status = "succeeded"
+            metrics.incr(f"jobs.{job.name}.succeeded")
+        except Exception as exc:  # pylint: disable=broad-except
+            state.error = f"{type(exc).__name__}: {exc}"
+            if job.attempt < job.retries:
+                delay = job.backoff * 2**job.attempt
+                state.status = "retrying"
+                logger.warning(f"Job {job.name} {job.id} failed, retrying in {delay}s: {state.error}")
+                metrics.incr(f"jobs.{job.name}.retried")
+                await self._retry(job.copy(update={"attempt": job.attempt + 1}), delay)
+            else:
+                state.status = "failed"
+                logger.error(f"Job {job.name} {job.id} failed: {state.error}")
+                metrics.incr(f"jobs.{job.name}.failed")
+        except asyncio.CancelledError:
+            await self._interrupted(job, state)
+            raise
+        finally:
+            current_job.reset(token)
+            self.running -= 1
+            metrics.observe(f"jobs.{job.name}.run", time.perf_counter() - started)
+        state.finished = time.time()
+        try:
+            await self.store(state)
+        except (aioredis.RedisError, OSError) as exc:
+            # The job ran, running it again to record its state would repeat its side effects
+            logger.error(f"Could not store the state of job {job.name} {job.id}: {exc}")
+
+    async def _work(self):
+        while True:
+            job = None
+            try:
+                while self.pending:
+                    # Jobs a Redis error interrupted before they started
+                    await self._push(self.pending[0])
+                    await self._done(self.pending.pop(0))
+                job = await self._pop()
+                if job is None:
+                    continue
+                if job.name not in job_registry:
+                    logger.error(f"No job registered as {job.name}")
+                    await self._done(job)
+                    continue
+                metrics.gauge("jobs.depth", await self.depth())
+                await self.execute(job)
+                await self._done(job)
+            except (aioredis.RedisError, OSError) as exc:
+                logger.error(f"Job queue unavailable: {exc}")
+                if job is not None and job.id not in {pending.id for pending in self.pending}:
+                    self.pending.append(job)
+                await asyncio.sleep(1)
+
+    async def _interrupted(self, job: Job, state: JobResult):
+        """Records a job cancelled by shutdown as failed, runners that can resume it override this"""
+        state.status = "failed"
+        state.error = "Interrupted by worker shutdown"
+        state.finished = time.time()
+        metrics.incr(f"jobs.{job.name}.interrupted")
+        try:
+            await self.store(state)
+        except (aioredis.RedisError, OSError) as exc:
+            logger.error(f"Could not store the state of job {job.name} {job.id}: {exc}")
+
+    async def _done(self, job: Job):
+        """Called once a popped job has been handled"""
+
+    @abstractmethod
+    async def _push(self, job: Job):
+        ...
+
+    @abstractmethod
+    async def _pop(self) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    async def _retry(self, job: Job, delay: float):
+        ...
+
+    @abstractmethod
+    async def depth(self) -> int:
+        ...
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self).__name__,
+            "workers": len(self.workers),
+            "running": self.running,
+            "depth": await self.depth(),
+        }
+
+
+class LocalJobRunner(JobRunner):
+    """Runs jobs on this worker's event loop from an in-memory priority queue"""
+
+    def __init__(self, concurrency: int = 8, ttl: float = 86400):
+        super().__init__(concurrency, ttl)
+        self._queue: "Optional[asyncio.PriorityQueue[Tuple[int, int, Job]]]" = None
+        self.sequence = itertools.count()
+
+    @property
+    def queue(self) -> "asyncio.PriorityQueue[Tuple[int, int, Job]]":
+        # Created on first use so it belongs to the running loop
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        return self._queue
+
+    async def _push(self, job: Job):
+        self.queue.put_nowait((job.priority, next(self.sequence), job))
+
+    async def _pop(self) -> Optional[Job]:
+        _, _, job = await self.queue.get()
+        return job
+
+    async def _retry(self, job: Job, delay: float):
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, (job.priority, next(self.sequence), job))
+
+    async def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def close(self):
+        await super().close()
+        if self.queue.qsize():
+            logger.warning(f"Dropping {self.queue.qsize()} queued jobs on shutdown")
+        while not self.queue.empty():
+            _, _, job = self.queue.get_nowait()
+            await self._interrupted(job, JobResult(id=job.id, name=job.name, attempt=job.attempt))
+
+
+class RedisJobRunner(JobRunner):
+    """Shares a Redis sorted set of jobs between workers, retries wait in a second set scored by due time.
+
+    Popped jobs are kept in a per-worker `jobs:processing:{worker}` hash until they are handled. A worker
+    whose `jobs:worker:{worker}` heartbeat expired died with them, the other workers put them back in the queue.
+    """
+
+    queue_key = "jobs:queue"
+    delayed_key = "jobs:delayed"
+    heartbeat = 10
+    reclaim_interval = 30
+
+    def __init__(self, concurrency: int = 8, ttl: float = 86400):
+        super().__init__(concurrency, ttl)
+        self.promoter: Optional["asyncio.Task[None]"] = None
+        self.worker_id = uuid4().hex
+        self.processing_key = f"jobs:processing:{self.worker_id}"
+
+    def start(self):
+        # Started first so the heartbeat is written before a worker holds a job
+        if self.promoter is None:
+            self.promoter = asyncio.create_task(self._promote())
+        super().start()
+
+    async def close(self):
+        if self.promoter is not None:
+            self.promoter.cancel()
+            self.promoter = None
+        await super().close()
+        try:
+            await pool.delete(f"jobs:worker:{self.worker_id}")
+        except (aioredis.RedisError, OSError) as exc:
+            logger.error(f"Could not remove the heartbeat of worker {self.worker_id}: {exc}")
+
+    async def _push(self, job: Job):
+        # Priority first, then submission time, so equal priorities run in order
+        await pool.zadd(self.queue_key, {job.json(): job.priority * 1e10 + time.time()})
+
+    async def _pop(self) -> Optional[Job]:
+        popped = await pool.bzpopmin(self.queue_key, timeout=1)
+        if popped is None:
+            return None
+        job = Job.parse_raw(popped[1])
+        await pool.hset(self.processing_key, job.id, popped[1])
+        return job
+
+    async def _done(self, job: Job):
+        await pool.hdel(self.processing_key, job.id)
+
+    async def _interrupted(self, job: Job, state: JobResult):
+        """Puts a job cancelled by shutdown back in the queue for another worker"""
+        try:
+            await self._push(job)
+            await self._done(job)
+            await self.store(state.copy(update={"status": "queued", "message": "Requeued after worker shutdown"}))
+            metrics.incr(f"jobs.{job.name}.requeued")
+        except (aioredis.RedisError, OSError) as exc:
+            logger.error(f"Could not requeue job {job.name} {job.id}, it is reclaimed once this worker's heartbeat expires: {exc}")
+
+    async def _retry(self, job: Job, delay: float):
+        await pool.zadd(self.delayed_key, {job.json(): time.time() + delay})
+
+    async def _reclaim(self):
+        """Requeues the jobs held by workers whose heartbeat expired, HDEL decides which worker moves each one"""
+        async for key in pool.scan_iter(match="jobs:processing:*"):
+            worker = key.decode("utf-8").rsplit(":", 1)[-1]
+            if worker == self.worker_id or await pool.exists(f"jobs:worker:{worker}"):
+                continue
+            for job_id, payload in (await pool.hgetall(key)).items():
+                if await pool.hdel(key, job_id):
+                    job = Job.parse_raw(payload)
+                    await self._push(job)
+                    await self.store(JobResult(id=job.id, name=job.name, attempt=job.attempt, message="Requeued from a lost worker"))
+                    logger.warning(f"Requeued job {job.name} {job.id} from lost worker {worker}")
+                    metrics.incr(f"jobs.{job.name}.reclaimed")
+
+    async def _promote(self):
+        """Keeps this worker's heartbeat, moves due retries back to the queue and reclaims jobs of lost workers.
+
+        ZREM decides which worker moves each retry.
+        """
+        reclaimed = 0.0
+        while True:
+            try:
+                await pool.set(f"jobs:worker:{self.worker_id}", 1, ex=self.heartbeat)
+                if time.monotonic() - reclaimed >= self.reclaim_interval:
+                    await self._reclaim()
+                    reclaimed = time.monotonic()
+                for member in await pool.zrangebyscore(self.delayed_key, 0, time.time()):
+                    if await pool.zrem(self.delayed_key, member):
+                        await self._push(Job.parse_raw(member))
+            except (aioredis.RedisError, OSError) as exc:
+                logger.error(f"Job scheduler lost Redis: {exc}")
+            await asyncio.sleep(1)
+
+    async def depth(self) -> int:
+        return await pool.zcard(self.queue_key)
+
+
+def create_runner(backend: str) -> JobRunner:
+    """Runner for a JOB_BACKEND value: `local` or `redis`"""
+    if backend == "redis":
+        return RedisJobRunner(env.JOB_CONCURRENCY, env.JOB_RESULT_TTL)
+    return LocalJobRunner(env.JOB_CONCURRENCY, env.JOB_RESULT_TTL)
+
+
+jobs = create_runner(env.JOB_BACKEND)
+
+
+def task(
+    func: Optional[Callable[..., Any]] = None,
+    *,
+    priority: int = 0,
+    retries: Optional[int] = None,
+    timeout: Optional[float] = None,
+    backoff: float = 1.0,
+):
+    """Registers a function as a job, calling it enqueues a run and returns the job id"""
+
+    def decorator(func: Callable[..., Any]) -> Callable[..., Awaitable[str]]:
+        if asyncio.iscoroutinefunction(func):
+            job_registry[func.__name__] = func
+        else:
+            job_registry[func.__name__] = functools.partial(asyncio.to_thread, func)
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> str:
+            return await jobs.submit(
+                Job(
+                    name=func.__name__,
+                    args=list(args),
+                    kwargs=kwargs,
+                    priority=priority,
+                    retries=env.JOB_RETRIES if retries is None else retries,
+                    timeout=env.JOB_TIMEOUT if timeout is None else timeout,
+                    backoff=backoff,
+                )
+            )
 
-app = Celery(__name__,backend=env.REDIS_URL,broker=env.REDIS_URL)
+        return wrapper
 
-def task(func):
-    """Decorator to defer the execution of a function to a Celery Worker"""
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        app.send_task(func.__name__, args=args, kwargs=kwargs)
-    return wrapper
\ No newline at end of file
+    if func is None:
+        return decorator
+    return decorator(func)
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+
+class LRUCache(Generic[T]):
+    """Size and TTL bounded LRU cache, hits and misses are reported to `metrics`"""
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, T]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable):
+        return self.peek(key) is not None
+
+    def peek(self, key: Hashable) -> Optional[T]:
+        """Returns the live entry without touching recency or stats"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key: Hashable) -> Optional[T]:
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+            metrics.incr(f"cache.{self.name}.misses")
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        metrics.incr(f"cache.{self.name}.hits")
+        return value
+
+    def set(self, key: Hashable, value: T, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+            metrics.incr(f"cache.{self.name}.evictions")
+        metrics.gauge(f"cache.{self.name}.size", len(self._data))
+
+    def pop(self, key: Hashable) -> Optional[T]:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
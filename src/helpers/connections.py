@@ -0,0 +1,5 @@
+import aioredis
+
+from ..config import env
+
+pool = aioredis.Redis.from_url(env.REDIS_URL)
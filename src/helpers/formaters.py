@@ -1,8 +1,29 @@
+import hashlib
+from typing import List
+
+import aioredis
+import pygments
 from aiofauna import Request, Response, WebSocketResponse
+from aiofauna.utils import setup_logging
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import MarkdownLexer, get_lexer_by_name
 
+from ..config import env
+from .cache import LRUCache
+from .connections import pool
+
+logger = setup_logging(__name__)
+
+RENDERER_VERSION = f"1-pygments-{pygments.__version__}"
+
+markdown_lexer = MarkdownLexer()
+html_formatter = HtmlFormatter()
+
+rendered: LRUCache[str] = LRUCache(
+    "rendered", maxsize=env.RENDER_CACHE_SIZE, ttl=env.RENDER_CACHE_TTL
+)
+
 
 class MarkdownRenderer(object):
     def __init__(self, text, language=None):
@@ -13,9 +34,8 @@ class MarkdownRenderer(object):
         if self.language:
             lexer = get_lexer_by_name(self.language)
         else:
-            lexer = MarkdownLexer()
-        formatter = HtmlFormatter()
-        return highlight(self.text, lexer, formatter)
+            lexer = markdown_lexer
+        return highlight(self.text, lexer, html_formatter)
 
     async def stream(self, websocket: WebSocketResponse):
         await websocket.send_str(self.format())
@@ -28,3 +48,41 @@ class MarkdownRenderer(object):
 
 def markdown(text: str):
     return MarkdownRenderer(text).format()
+
+
+def rendered_key(text: str) -> str:
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"md:{RENDERER_VERSION}:{digest}"
+
+
+async def render_many(texts: List[str]) -> List[str]:
+    """`markdown` for each text, served from the local cache, then Redis, then rendered.
+
+    Redis is only a cache here, when it is unreachable the texts are rendered locally.
+    """
+    keys = [rendered_key(text) for text in texts]
+    results = [rendered.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results  # type: ignore
+    try:
+        stored = await pool.mget([keys[i] for i in missing])
+    except (aioredis.RedisError, OSError) as exc:
+        logger.warning(f"Rendered cache unavailable, rendering locally: {exc!r}")
+        stored = [None] * len(missing)
+    fresh = {}
+    for i, value in zip(missing, stored):
+        if value is not None:
+            results[i] = value.decode("utf-8")
+        else:
+            results[i] = fresh[keys[i]] = markdown(texts[i])
+        rendered.set(keys[i], results[i])
+    if fresh:
+        try:
+            async with pool.pipeline(transaction=False) as pipe:
+                for key, html in fresh.items():
+                    pipe.set(key, html, ex=int(env.RENDER_CACHE_TTL))
+                await pipe.execute()
+        except (aioredis.RedisError, OSError) as exc:
+            logger.warning(f"Could not store {len(fresh)} renders: {exc!r}")
+    return results  # type: ignore
@@ -0,0 +1,186 @@
+import hashlib
+import json
+from dataclasses import dataclass
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+import openai
+from aiofauna.llm.llm import LLMStack, QueryRequest
+from aiofauna.llm.schemas import Model
+from aiofauna.utils import setup_logging
+
+from ..config import env
+from .metrics import metrics
+from .registry import FunctionSet, functions_registry
+from .semantic import SemanticCache
+from .singleflight import coalesce
+
+logger = setup_logging(__name__)
+
+semantic_cache = SemanticCache(
+    threshold=env.SEMANTIC_CACHE_THRESHOLD,
+    maxsize=env.SEMANTIC_CACHE_SIZE,
+    ttl=env.SEMANTIC_CACHE_TTL,
+    maxscopes=env.SEMANTIC_CACHE_SCOPES,
+)
+
+
+@coalesce("function_call")
+async def function_call(
+    text: str,
+    context: Optional[str] = None,
+    model: Model = "gpt-4-0613",
+    functions: Optional[FunctionSet] = None,
+) -> Any:
+    """Same dispatch as `aiofauna.llm.function_call` over precomputed specs.
+
+    `functions` defaults to every registered FunctionType, endpoints pass a `functions_registry.subset`
+    to keep the prompt small. Identical concurrent calls are coalesced.
+    """
+    if functions is None:
+        functions = functions_registry.all
+    messages = [{"role": "user", "content": text}]
+    if context is not None:
+        messages.append({"role": "system", "content": context})
+    response = await openai.ChatCompletion.acreate(
+        model=model, messages=messages, functions=functions.specs
+    )
+    choice = response["choices"][0]["message"]  # type: ignore
+    if "function_call" not in choice:
+        return choice["content"]
+    name = choice["function_call"]["name"]
+    function = functions.get(name)
+    if function is None:
+        raise ValueError(f"Function {name} not found")
+    metrics.incr(f"functions.{name}")
+    return await function.run(function(**json.loads(choice["function_call"]["arguments"])))
+
+
+@dataclass
+class LLM(LLMStack):
+    """LLMStack with streamed completions that keep the system context.
+
+    Identical concurrent `chat`, `chat_with_memory` and `create_embeddings` calls share one request.
+    """
+
+    @coalesce("llm.chat")
+    async def chat(self, text: str, context: str) -> str:
+        return await super().chat(text=text, context=context)
+
+    @coalesce("llm.chat_with_memory")
+    async def chat_with_memory(self, text: str, namespace: str, context: str) -> str:
+        return await super().chat_with_memory(text=text, namespace=namespace, context=context)
+
+    @coalesce("llm.create_embeddings")
+    async def create_embeddings(self, text: str) -> List[float]:
+        return await super().create_embeddings(text)
+
+    async def memory_messages(
+        self, text: str, namespace: str, context: str, embedding: Optional[List[float]] = None
+    ) -> List[Dict[str, str]]:
+        """Messages `chat_with_memory` sends, reusing `embedding` when it is already known"""
+        if embedding is None:
+            embedding = await self.create_embeddings(text)
+        query_response = await self.query_vectors(
+            QueryRequest(
+                vector=embedding, namespace=namespace, topK=3, includeMetadata=True
+            )
+        )
+        similar_text_chunks = [
+            i.get("metadata", {}).get("text", "") for i in query_response.matches  # type: ignore
+        ]
+        similar_text = "Previous Similar results:" + "\n".join(similar_text_chunks)
+        return [
+            {"role": "user", "content": text},
+            {"role": "system", "content": similar_text},
+            {"role": "system", "content": context},
+        ]
+
+    async def chat_stream(
+        self, text: str, context: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
+        """Chat completion stream with an optional system context"""
+        messages = [{"role": "user", "content": text}]
+        if context is not None:
+            messages.append({"role": "system", "content": context})
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-4-0613", messages=messages, stream=True
+        )
+        async for chunk in response:  # type: ignore
+            delta = chunk["choices"][0]["delta"]
+            if "content" in delta:
+                yield delta["content"]
+
+    async def chat_stream_with_context(
+        self, text: str, namespace: str, context: str, embedding: Optional[List[float]] = None
+    ) -> AsyncGenerator[str, None]:
+        """Same prompt as `chat_with_memory`, yielding content deltas as they arrive"""
+        response = await openai.ChatCompletion.acreate(
+            model="gpt-4-0613",
+            messages=await self.memory_messages(text, namespace, context, embedding),
+            stream=True,
+        )
+        async for chunk in response:  # type: ignore
+            delta = chunk["choices"][0]["delta"]
+            if "content" in delta:
+                yield delta["content"]
+
+    @staticmethod
+    def cache_scope(
+        namespace: Optional[str] = None, user: Optional[str] = None
+    ) -> Optional[str]:
+        """Semantic cache partition for the configured SEMANTIC_CACHE_SCOPE, None when disabled"""
+        mode = env.SEMANTIC_CACHE_SCOPE
+        if mode == "global":
+            return "global"
+        if mode == "user" and user:
+            return f"user:{user}"
+        if mode == "namespace" and namespace:
+            return f"namespace:{namespace}"
+        return None
+
+    @staticmethod
+    def context_scope(scope: str, context: str) -> str:
+        """Partition of `scope` for answers given under this exact system context"""
+        return f"{scope}:{hashlib.sha1(context.encode('utf-8')).hexdigest()}"
+
+    async def semantic_lookup(
+        self, text: str, scope: str
+    ) -> Tuple[Optional[str], List[float]]:
+        """Cached answer for a near duplicate of `text`, and the embedding used to look it up"""
+        embedding = await self.create_embeddings(text)
+        return semantic_cache.lookup(scope, embedding), embedding
+
+    async def cached_chat(self, text: str, context: str, scope: Optional[str] = None) -> str:
+        """`chat` answered from the semantic cache when `scope` is set.
+
+        One-shot answers depend on the system context, so it is part of the partition.
+        """
+        if scope is None:
+            return await self.chat(text=text, context=context)
+        scope = self.context_scope(scope, context)
+        answer, embedding = await self.semantic_lookup(text, scope)
+        if answer is None:
+            answer = await self.chat(text=text, context=context)
+            semantic_cache.add(scope, embedding, answer)
+        return answer
+
+    async def cached_chat_with_memory(
+        self, text: str, namespace: str, context: str, scope: Optional[str] = None
+    ) -> str:
+        """`chat_with_memory` answered from the semantic cache when `scope` is set.
+
+        `context` carries the conversation title and recent history, so a follow up is only answered
+        from the cache within a conversation in the same state.
+        """
+        if scope is None:
+            return await self.chat_with_memory(text=text, namespace=namespace, context=context)
+        scope = self.context_scope(scope, context)
+        answer, embedding = await self.semantic_lookup(text, scope)
+        if answer is None:
+            response = await openai.ChatCompletion.acreate(
+                model="gpt-4-0613",
+                messages=await self.memory_messages(text, namespace, context, embedding),
+            )
+            answer = response["choices"][0]["message"]["content"]  # type: ignore
+            semantic_cache.add(scope, embedding, answer)
+        return answer
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Union
+
+Number = Union[int, float]
+
+
+class Metrics(object):
+    """In-process counters, gauges and timing summaries"""
+
+    def __init__(self):
+        self.counters: Dict[str, Number] = defaultdict(int)
+        self.gauges: Dict[str, Number] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: Number = 1):
+        self.counters[name] += value
+
+    def gauge(self, name: str, value: Number):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        summary = self.timings.setdefault(
+            name, {"count": 0, "sum": 0.0, "max": 0.0, "last": 0.0}
+        )
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+        summary["last"] = value
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": {
+                name: {**summary, "avg": summary["sum"] / summary["count"]}
+                for name, summary in self.timings.items()
+                if summary["count"]
+            },
+        }
+
+
+metrics = Metrics()
+
+
+async def watch_loop(interval: float = 0.5, threshold: float = 0.1):
+    """Records how late the event loop wakes up from a sleep, anything late was blocked by a callback"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        metrics.observe("loop.lag", lag)
+        if lag >= threshold:
+            metrics.incr("loop.stalls")
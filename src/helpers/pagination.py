@@ -0,0 +1,110 @@
+import base64
+import binascii
+import json
+from typing import (Any, AsyncGenerator, AsyncIterable, Dict, List, Optional,
+                    Tuple, Type, TypeVar)
+
+from aiofauna import FaunaModel, q
+from aiofauna.faunadb.objects import Expr
+from aiofauna.json import FaunaJSONEncoder
+from aiohttp.web import Request, StreamResponse
+from aiohttp.web_exceptions import HTTPBadRequest
+
+from ..config import env
+
+T = TypeVar("T", bound=FaunaModel)
+
+
+def from_document(model: Type[T], data: Dict[str, Any]) -> T:
+    """Builds a model from a raw Fauna document, the same way `FaunaModel.get` does"""
+    return model(
+        **{
+            **data["data"],
+            "ref": data["ref"]["@ref"]["id"],
+            "ts": data["ts"] / 1000,
+        }
+    )
+
+
+def encode_cursor(after: Any) -> Optional[str]:
+    """Opaque cursor holding the id of the document Fauna's `after` points at.
+
+    The indexes paginated here have no values, so `after` is `[Ref]`.
+    """
+    if not after:
+        return None
+    ref = after[0]["@ref"]["id"]
+    return base64.urlsafe_b64encode(json.dumps({"id": ref}).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(model: Type[FaunaModel], cursor: Optional[str]) -> Optional[List[Expr]]:
+    """Fauna's `after` for a cursor made by `encode_cursor`, the ref is rebuilt in the model's collection"""
+    if not cursor:
+        return None
+    try:
+        ref = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))["id"]
+        if not isinstance(ref, str) or not ref.isdigit():
+            raise ValueError(ref)
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        raise HTTPBadRequest(text=f"Invalid cursor {cursor!r}") from None
+    return [q.ref(q.collection(model.__name__.lower()), ref)]
+
+
+def page_params(request: Request) -> Tuple[str, int, str]:
+    """`after`, `limit` and `format` from the query string.
+
+    Optional scalars are read here because the route loader hands the request object
+    to any parameter missing from the query. `limit` is capped at `PAGE_SIZE_MAX`.
+    """
+    query = request.query
+    try:
+        limit = int(query.get("limit", 0))
+    except ValueError:
+        raise HTTPBadRequest(text=f"limit must be an integer, got {query['limit']!r}") from None
+    if limit < 0:
+        raise HTTPBadRequest(text=f"limit must not be negative, got {limit}")
+    return query.get("after", ""), min(limit, env.PAGE_SIZE_MAX), query.get("format", "json")
+
+
+async def paginate(
+    model: Type[T], after: Optional[str] = None, limit: int = 50, **kwargs: Any
+) -> Tuple[List[T], Optional[str]]:
+    """One page of documents matching the `{model}_{field}` index and the cursor of the next one"""
+    field, value = list(kwargs.items())[0]
+    response = await model.q()(
+        q.map_(
+            q.lambda_("ref", q.get(q.var("ref"))),
+            q.paginate(
+                q.match(q.index(f"{model.__name__.lower()}_{field}"), value),
+                size=limit,
+                after=decode_cursor(model, after),
+            ),
+        )
+    )
+    items = [from_document(model, data) for data in response["data"]]
+    return items, encode_cursor(response.get("after"))
+
+
+async def iterate(
+    model: Type[T], after: Optional[str] = None, page_size: int = 100, **kwargs: Any
+) -> AsyncGenerator[List[T], None]:
+    """Yields pages until the index is exhausted, only one page is held at a time"""
+    while True:
+        items, after = await paginate(model, after=after, limit=page_size, **kwargs)
+        if items:
+            yield items
+        if after is None:
+            break
+
+
+async def stream_ndjson(
+    request: Request, rows: AsyncIterable[Dict[str, Any]]
+) -> StreamResponse:
+    """Writes each row as a JSON line as soon as it is produced"""
+    response = StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    async for row in rows:
+        line = json.dumps(row, cls=FaunaJSONEncoder, separators=(",", ":"))
+        await response.write(line.encode("utf-8") + b"\n")
+    await response.write_eof()
+    return response
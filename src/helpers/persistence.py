@@ -0,0 +1,140 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+from aiofauna import FaunaModel, q
+from aiofauna.faunadb.objects import Expr
+from aiofauna.utils import setup_logging
+
+from ..config import env
+from .metrics import metrics
+
+logger = setup_logging(__name__)
+
+Flushed = Callable[[], Awaitable[Any]]
+
+
+def collection_name(model: FaunaModel) -> str:
+    return model.__class__.__name__.lower()
+
+
+def turn_expression(conversation: FaunaModel, *messages: FaunaModel) -> Expr:
+    """Creates the messages and appends their refs to `conversation.messages` in one query"""
+    ref = q.ref(q.collection(collection_name(conversation)), conversation.ref)
+    bindings = {
+        f"message_{i}": q.create(
+            q.collection(collection_name(message)), {"data": message.dict()}
+        )
+        for i, message in enumerate(messages)
+    }
+    return q.let(
+        bindings,
+        q.update(
+            ref,
+            {
+                "data": {
+                    "messages": q.append(
+                        [q.select(["ref", "id"], q.var(name)) for name in bindings],
+                        q.select(["data", "messages"], q.get(ref), []),
+                    )
+                }
+            },
+        ),
+    )
+
+
+class WriteBehind(object):
+    """Bounded queue of Fauna writes flushed in batches, each batch as one transaction"""
+
+    def __init__(self, maxsize: int = 1024, batch_size: int = 32):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        return self._queue
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def put(self, expr: Expr, flushed: Optional[Flushed] = None):
+        """Enqueues a write, waiting for room when the queue is full.
+
+        `flushed` is awaited once the batch holding the write has been sent to Fauna.
+        """
+        self.start()
+        await self.queue.put((expr, flushed))
+        metrics.gauge("persistence.queue_depth", self.queue.qsize())
+
+    async def save_turn(self, conversation: FaunaModel, *messages: FaunaModel, flushed: Optional[Flushed] = None):
+        await self.put(turn_expression(conversation, *messages), flushed)
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.flush([expr for expr, _ in batch])
+                await self.notify([flushed for _, flushed in batch if flushed is not None])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+                metrics.gauge("persistence.queue_depth", self.queue.qsize())
+
+    @staticmethod
+    async def query(expr: Expr):
+        response = await FaunaModel.q()(expr)
+        if isinstance(response, dict) and "errors" in response:
+            raise ValueError(response["errors"])
+        return response
+
+    async def flush(self, batch: List[Expr]):
+        started = time.perf_counter()
+        try:
+            await self.query(q.do(*batch))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error(f"Batch of {len(batch)} writes failed, retrying one by one: {exc}")
+            metrics.incr("persistence.batch_errors")
+            for expr in batch:
+                try:
+                    await self.query(expr)
+                except Exception as exc_:  # pylint: disable=broad-except
+                    logger.error(exc_)
+                    metrics.incr("persistence.dropped")
+        metrics.observe("persistence.flush_latency", time.perf_counter() - started)
+        metrics.incr("persistence.flushed", len(batch))
+
+    @staticmethod
+    async def notify(callbacks: List[Flushed]):
+        for callback in callbacks:
+            try:
+                await callback()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error(f"Write-behind flush callback failed: {exc!r}")
+
+    async def close(self, timeout: float = 10):
+        """Flushes whatever is queued within `timeout` seconds and stops the worker"""
+        if self._worker is None:
+            return
+        if self._worker.done() and not self.queue.empty():
+            # A worker that died would never drain the queue, start a new one to flush it
+            self.start()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Write-behind flush timed out after {timeout}s, {self.queue.qsize()} writes still queued")
+            metrics.incr("persistence.close_timeouts")
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+
+
+write_behind = WriteBehind(
+    maxsize=env.WRITE_BEHIND_QUEUE_SIZE, batch_size=env.WRITE_BEHIND_BATCH_SIZE
+)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from aiofauna.utils import setup_logging
+
+from ..config import env
+from .background import report_progress
+from .metrics import metrics
+
+logger = setup_logging(__name__)
+
+_limiter: Optional[asyncio.Semaphore] = None
+
+
+def limiter() -> asyncio.Semaphore:
+    """Semaphore shared by the steps of every plan on this worker, created on first use so it belongs to the running loop"""
+    global _limiter  # pylint: disable=global-statement
+    if _limiter is None:
+        _limiter = asyncio.Semaphore(env.PLAN_CONCURRENCY)
+    return _limiter
+
+
+class Step(object):
+    """A named coroutine function called with the results of the steps it depends on as keyword arguments"""
+
+    def __init__(self, name: str, func: Callable[..., Awaitable[Any]], after: Sequence[str] = ()):
+        self.name = name
+        self.func = func
+        self.after = list(after)
+
+    def __repr__(self) -> str:
+        return f"Step({self.name}, after={self.after})"
+
+
+class Plan(object):
+    """Steps with declared dependencies, each one starts as soon as the steps it depends on are done.
+
+    Independent steps run concurrently under the shared `limiter`, the first failure cancels the
+    steps still pending and is raised from `run`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.steps: Dict[str, Step] = {}
+        self.timings: Dict[str, float] = {}
+
+    def add(self, name: str, func: Callable[..., Awaitable[Any]], after: Sequence[str] = ()) -> "Plan":
+        if name in self.steps:
+            raise ValueError(f"Step {name} is already part of plan {self.name}")
+        self.steps[name] = Step(name, func, after)
+        return self
+
+    def step(self, name: Optional[str] = None, after: Sequence[str] = ()):
+        """Decorator form of `add`, the step is named after the function by default"""
+
+        def decorator(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self.add(name or func.__name__, func, after)
+            return func
+
+        return decorator
+
+    def order(self) -> List[Step]:
+        """Steps in dependency order, rejecting unknown dependencies and cycles"""
+        ordered: List[Step] = []
+        visiting: List[str] = []
+        done = set()
+
+        def visit(step: Step):
+            if step.name in done:
+                return
+            if step.name in visiting:
+                raise ValueError(f"Plan {self.name} has a cycle: {' -> '.join([*visiting, step.name])}")
+            visiting.append(step.name)
+            for dependency in step.after:
+                if dependency not in self.steps:
+                    raise ValueError(f"Step {step.name} depends on unknown step {dependency}")
+                visit(self.steps[dependency])
+            visiting.pop()
+            done.add(step.name)
+            ordered.append(step)
+
+        for step in self.steps.values():
+            visit(step)
+        return ordered
+
+    async def run(self) -> Dict[str, Any]:
+        """Runs every step and returns their results by name"""
+        order = self.order()
+        tasks: Dict[str, "asyncio.Future[Any]"] = {}
+        finished = 0
+
+        async def execute(step: Step) -> Any:
+            nonlocal finished
+            inputs = {dependency: await tasks[dependency] for dependency in step.after}
+            # Taken once the dependencies are done so waiting steps do not hold a slot
+            async with limiter():
+                started = time.perf_counter()
+                try:
+                    result = await step.func(**inputs)
+                finally:
+                    self.timings[step.name] = time.perf_counter() - started
+                    metrics.observe(f"plan.{self.name}.{step.name}", self.timings[step.name])
+            finished += 1
+            await report_progress(finished / len(order), f"{step.name} done")
+            return result
+
+        started = time.perf_counter()
+        for step in order:
+            tasks[step.name] = asyncio.ensure_future(execute(step))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            metrics.incr(f"plan.{self.name}.failed")
+            raise
+        finally:
+            metrics.observe(f"plan.{self.name}", time.perf_counter() - started)
+        logger.info(f"Plan {self.name} finished: {self.timings}")
+        return {name: task.result() for name, task in tasks.items()}
@@ -0,0 +1,88 @@
+import json
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Type
+
+from aiofauna.typedefs import FunctionType
+
+from .tokens import count_tokens
+
+
+class FunctionSet(object):
+    """FunctionType classes with their OpenAI specs, serialised and priced once"""
+
+    def __init__(self, functions: Sequence[Type[FunctionType]]):
+        self.functions: Dict[str, Type[FunctionType]] = {
+            function.__name__: function for function in functions
+        }
+        self.specs: List[Dict[str, Any]] = [
+            function.openaischema for function in functions  # type: ignore
+        ]
+        self.costs: Dict[str, int] = {
+            spec["name"]: count_tokens(json.dumps(spec)) for spec in self.specs
+        }
+        self.tokens = sum(self.costs.values())
+
+    def __iter__(self) -> Iterator[Type[FunctionType]]:
+        return iter(self.functions.values())
+
+    def __len__(self) -> int:
+        return len(self.functions)
+
+    def __repr__(self) -> str:
+        return f"FunctionSet({', '.join(self.functions)})"
+
+    def get(self, name: str) -> Optional[Type[FunctionType]]:
+        return self.functions.get(name)
+
+
+class FunctionRegistry(object):
+    """Every registered FunctionType and memoised per-endpoint subsets of them"""
+
+    def __init__(self):
+        self._all: Optional[FunctionSet] = None
+        self.subsets: Dict[Tuple[str, ...], FunctionSet] = {}
+
+    def build(self) -> FunctionSet:
+        """Builds the full set from the FunctionType subclasses imported so far"""
+        self._all = FunctionSet(FunctionType._subclasses)  # pylint: disable=protected-access
+        self.subsets.clear()
+        return self._all
+
+    @property
+    def all(self) -> FunctionSet:
+        # Rebuilt if a FunctionType was defined after the last build
+        if self._all is None or len(self._all) != len(FunctionType._subclasses):  # pylint: disable=protected-access
+            return self.build()
+        return self._all
+
+    def subset(self, *names: str) -> FunctionSet:
+        """The named functions only, every function when no names are given"""
+        if not names:
+            return self.all
+        key = tuple(sorted(set(names)))
+        functions = self.all
+        subset = self.subsets.get(key)
+        if subset is None:
+            missing = [name for name in key if functions.get(name) is None]
+            if missing:
+                raise KeyError(f"Unknown functions: {', '.join(missing)}")
+            subset = FunctionSet([functions.functions[name] for name in key])
+            self.subsets[key] = subset
+        return subset
+
+    def stats(self) -> Dict[str, Any]:
+        functions = self.all
+        return {
+            "functions": functions.costs,
+            "tokens": functions.tokens,
+            "subsets": {
+                ",".join(key): subset.tokens for key, subset in self.subsets.items()
+            },
+        }
+
+
+functions_registry = FunctionRegistry()
+
+
+def requested_functions(value: str) -> List[str]:
+    """Function names from a comma separated `functions` query parameter"""
+    return [name.strip() for name in value.split(",") if name.strip()]
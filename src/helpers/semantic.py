@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .metrics import metrics
+
+
+class Partition(object):
+    """Normalised embeddings and their answers for one cache scope"""
+
+    def __init__(self, dimensions: int):
+        self.vectors = np.empty((0, dimensions), dtype=np.float32)
+        self.expires = np.empty((0,), dtype=np.float64)
+        self.answers: List[str] = []
+
+    def __len__(self):
+        return len(self.answers)
+
+    def keep(self, mask: np.ndarray):
+        self.vectors = self.vectors[mask]
+        self.expires = self.expires[mask]
+        self.answers = [answer for answer, kept in zip(self.answers, mask) if kept]
+
+
+class SemanticCache(object):
+    """Answers stored by prompt embedding, looked up by cosine similarity within a scope.
+
+    A scope is dropped once its last entry expires, and the least recently used scopes are
+    evicted beyond `maxscopes`.
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 1024, ttl: float = 3600, maxscopes: int = 4096):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxscopes = maxscopes
+        self.partitions: "OrderedDict[str, Partition]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def lookup(self, scope: str, vector: List[float]) -> Optional[str]:
+        partition = self.partitions.get(scope)
+        if partition is not None:
+            partition.keep(partition.expires > time.monotonic())
+            if not partition:
+                del self.partitions[scope]
+        if not partition:
+            return self._miss()
+        self.partitions.move_to_end(scope)
+        similarities = partition.vectors @ self.normalize(vector)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return self._miss()
+        self.hits += 1
+        metrics.incr("semantic.hits")
+        return partition.answers[best]
+
+    def add(self, scope: str, vector: List[float], answer: str):
+        normalized = self.normalize(vector)
+        partition = self.partitions.get(scope)
+        if partition is None:
+            partition = self.partitions[scope] = Partition(normalized.shape[0])
+            while len(self.partitions) > self.maxscopes:
+                self.partitions.popitem(last=False)
+                metrics.incr("semantic.scope_evictions")
+        self.partitions.move_to_end(scope)
+        if len(partition) >= self.maxsize:
+            partition.keep(np.arange(len(partition)) >= len(partition) - self.maxsize + 1)
+            metrics.incr("semantic.evictions")
+        partition.vectors = np.vstack([partition.vectors, normalized])
+        partition.expires = np.append(partition.expires, time.monotonic() + self.ttl)
+        partition.answers.append(answer)
+
+    def _miss(self) -> None:
+        self.misses += 1
+        metrics.incr("semantic.misses")
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "scopes": len(self.partitions),
+            "entries": sum(len(partition) for partition in self.partitions.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,76 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import json
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, TypeVar
+
+from .metrics import metrics
+
+T = TypeVar("T")
+
+
+def request_key(name: str, arguments: Dict[str, Any]) -> str:
+    """Stable key for a call, argument order and surrounding whitespace do not matter"""
+    normalized = {
+        key: value.strip() if isinstance(value, str) else value
+        for key, value in arguments.items()
+    }
+    payload = json.dumps(
+        [name, normalized], sort_keys=True, default=repr, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight(object):
+    """Concurrent callers with the same key share one in-flight call"""
+
+    def __init__(self):
+        self.calls: Dict[str, "asyncio.Future[Any]"] = {}
+        self.executed: Dict[str, int] = defaultdict(int)
+        self.coalesced: Dict[str, int] = defaultdict(int)
+
+    async def do(self, name: str, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced[name] += 1
+            metrics.incr(f"singleflight.{name}.coalesced")
+        else:
+            future = asyncio.ensure_future(factory())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+            self.executed[name] += 1
+        # A cancelled caller must not cancel the call the others are awaiting
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self.calls),
+            "executed": dict(self.executed),
+            "coalesced": dict(self.coalesced),
+        }
+
+
+flights = SingleFlight()
+
+
+def coalesce(name: str):
+    """Decorator routing an async function through the shared `flights`"""
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> T:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return await flights.do(
+                name,
+                request_key(name, bound.arguments),
+                lambda: func(*args, **kwargs),
+            )
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterable, Awaitable, Callable, Deque, Dict, Optional, Tuple
+from uuid import uuid4
+
+from aiofauna.utils import setup_logging
+from aiohttp_sse import EventSourceResponse
+
+from ..config import env
+from .metrics import metrics
+
+logger = setup_logging(__name__)
+
+Event = Tuple[Optional[str], str]
+
+KEEPALIVE = b": keepalive\r\n\r\n"
+
+
+class SSEClient(object):
+    """An SSE response fed through a bounded buffer and drained by its own writer.
+
+    When the buffer is full the policy decides: `drop` discards the oldest event, `coalesce`
+    collapses the backlog into the newest event and `disconnect` ends the stream.
+    """
+
+    def __init__(
+        self,
+        sse: EventSourceResponse,
+        channel: str,
+        maxsize: int = 256,
+        policy: str = "drop",
+        keepalive: float = 15,
+        timeout: float = 10,
+        on_sent: Optional[Callable[[Event], Awaitable[None]]] = None,
+    ):
+        self.id = uuid4().hex
+        self.sse = sse
+        self.channel = channel
+        self.maxsize = maxsize
+        self.policy = policy
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.on_sent = on_sent
+        self.buffer: Deque[Tuple[float, Event]] = deque()
+        self.ready = asyncio.Event()
+        self.closed: Optional[str] = None
+        self.finished = False
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0
+
+    def offer(self, event: Event):
+        """Buffers an event without waiting on the client"""
+        if len(self.buffer) >= self.maxsize:
+            if self.policy == "disconnect":
+                self.close("overflow")
+                return
+            if self.policy == "coalesce":
+                self.dropped += len(self.buffer)
+                self.buffer.clear()
+            else:
+                self.buffer.popleft()
+                self.dropped += 1
+            metrics.incr(f"sse.{self.policy}")
+        self.buffer.append((time.monotonic(), event))
+        self.ready.set()
+
+    def close(self, reason: str):
+        if self.closed is None:
+            logger.warning(f"Closing SSE client on {self.channel}: {reason}")
+            metrics.incr(f"sse.closed.{reason}")
+            self.closed = reason
+            self.ready.set()
+
+    async def _pump(self, events: AsyncIterable[Event]):
+        try:
+            async for event in events:
+                self.offer(event)
+                if self.closed is not None:
+                    break
+        finally:
+            self.finished = True
+            self.ready.set()
+
+    async def _write(self):
+        while self.closed is None:
+            if not self.buffer:
+                if self.finished:
+                    return
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), self.keepalive)
+                except asyncio.TimeoutError:
+                    await asyncio.wait_for(self.sse.write(KEEPALIVE), self.timeout)
+                continue
+            queued, event = self.buffer.popleft()
+            await asyncio.wait_for(self.sse.send(event[1], id=event[0]), self.timeout)
+            if self.on_sent is not None:
+                await self.on_sent(event)
+            self.sent += 1
+            self.lag = time.monotonic() - queued
+            metrics.observe("sse.lag", self.lag)
+
+    async def run(self, events: AsyncIterable[Event]):
+        pump = asyncio.create_task(self._pump(events))
+        try:
+            await self._write()
+        except asyncio.TimeoutError:
+            self.close("timeout")
+        except (ConnectionResetError, RuntimeError) as exc:
+            self.close("disconnected")
+            logger.info(exc)
+        finally:
+            pump.cancel()
+            try:
+                await pump
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "channel": self.channel,
+            "depth": len(self.buffer),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "lag": self.lag,
+        }
+
+
+class SSERegistry(object):
+    """Delivers event sources to SSE responses and tracks every open client"""
+
+    def __init__(self):
+        self.clients: Dict[str, SSEClient] = {}
+
+    async def deliver(
+        self,
+        sse: EventSourceResponse,
+        events: AsyncIterable[Event],
+        channel: str,
+        on_sent: Optional[Callable[[Event], Awaitable[None]]] = None,
+    ):
+        """Streams `events` to `sse` until the source ends or the client is closed, `on_sent` runs after each write"""
+        client = SSEClient(
+            sse,
+            channel,
+            maxsize=env.SSE_QUEUE_SIZE,
+            policy=env.SSE_OVERFLOW,
+            keepalive=env.SSE_KEEPALIVE,
+            timeout=env.SSE_SEND_TIMEOUT,
+            on_sent=on_sent,
+        )
+        self.clients[client.id] = client
+        metrics.gauge("sse.clients", len(self.clients))
+        try:
+            await client.run(events)
+        finally:
+            del self.clients[client.id]
+            metrics.gauge("sse.clients", len(self.clients))
+
+    def stats(self) -> Dict[str, Any]:
+        return {client_id: client.stats() for client_id, client in self.clients.items()}
+
+
+sse_clients = SSERegistry()
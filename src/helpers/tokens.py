@@ -0,0 +1,28 @@
+import functools
+from typing import Callable, Iterable, List, TypeVar
+
+import tiktoken
+
+T = TypeVar("T")
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4") -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    """Number of tokens `text` takes for `model`"""
+    return len(get_encoding(model).encode(text or ""))
+
+
+def fit_budget(items: Iterable[T], budget: int, cost: Callable[[T], int]) -> List[T]:
+    """Newest items (last in `items`) that fit in `budget` tokens, oldest first"""
+    selected: List[T] = []
+    for item in reversed(list(items)):
+        budget -= cost(item)
+        if budget < 0:
+            break
+        selected.append(item)
+    selected.reverse()
+    return selected
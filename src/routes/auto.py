@@ -1,11 +1,10 @@
-from typing import Any,List
+from typing import Any,Dict,List,Optional
 from uuid import uuid4
 from aiofauna import APIServer
 from aiofauna.json import to_json
-from aiofauna.llm import function_call
 from aiofauna.llm.llm import Model
 from aiofauna.typedefs import FunctionType
-from aiohttp import ClientSession
+from aiohttp.web_exceptions import HTTPBadRequest, HTTPNotFound
 from jinja2 import Template
 from markdown_it import MarkdownIt
 from markdown_it.renderer import RendererHTML
@@ -13,13 +12,21 @@ from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import get_lexer_by_name
 from src.helpers.loaders import ingest_pdf, pdf_reader
+from src.helpers.pagination import iterate, page_params, paginate, stream_ndjson
+from src.helpers.plan import Plan
 from src.schemas import *
 from src.tools import content
 from src.tools.content import \
     CreateImageRequest  # pylint: disable=no-name-in-module
-from ..helpers import task
+from ..config import env
+from ..helpers import jobs, report_progress, task
+from ..helpers.metrics import metrics
 from ..services import *
 from ..services.pubsub import FunctionQueue
+from ..services.transfer import public_url, transfers
+from ..helpers.llm import function_call
+from ..helpers.registry import functions_registry, requested_functions
+from ..helpers.sse import sse_clients
 
 context_template = Template(
     """
@@ -53,21 +60,55 @@ md = MarkdownIt(
     renderer_cls=HighlightRenderer,
 )
 
-s3 = session.client("s3", region_name="us-east-1")
-
 
 def render_markdown(text: str) -> str:
     """Render markdown to html"""
     return md.render(text)
 
-@task
-async def automate(text: str, namespace: str):
+@task(retries=0)
+async def automate(text: str, namespace: str, functions: Optional[List[str]] = None):
+    await report_progress(0.0, "Calling functions")
     response = await function_call(
-        text=text, context=context_template.render(text=text)
+        text=text,
+        context=context_template.render(text=text),
+        functions=functions_registry.subset(*(functions or [])),
     )
     resturnable = DeterministicFunction(response=response, type=type(response).__name__)
-    queue = FunctionQueue(namespace=namespace)
-    await queue.pub(message=to_json(resturnable))
+    await FunctionQueue(namespace=namespace).publish(to_json(resturnable))
+    return resturnable
+
+@task(retries=0)
+async def generate_blogpost(request: Dict[str, Any], namespace: str):
+    """Creates a blogpost with a cover image and publishes it to the namespace"""
+    bucket_name = "images-aiofauna"
+    blogpost_webpage = BlogPostWebPage(**request)
+    key = f"{blogpost_webpage.user}/{uuid4()}.png"
+    # Known before the image exists so the content is written while it is generated and uploaded
+    blogpost_webpage.image = public_url(bucket_name, key)
+    plan = Plan("blogpost")
+
+    @plan.step()
+    async def image():
+        return await CreateImageRequest(prompt=blogpost_webpage.image_prompt).run()
+
+    @plan.step(after=["image"])
+    async def upload(image: str):
+        await transfers.upload_url(image, bucket_name, key, ACL="public-read", ContentType="image/png")
+        await report_progress(partial={"image": blogpost_webpage.image})
+
+    await report_progress(0.0, "Generating cover image and content")
+    response = await blogpost_webpage.create_content(plan)
+    await FunctionQueue(namespace=namespace).publish(to_json(response))
+    return response
+
+@task(retries=0, timeout=env.JOB_INGEST_TIMEOUT)
+async def ingest_document(texts: List[str], namespace: str):
+    """Upserts the embeddings of the extracted PDF pages into the namespace"""
+    returns = []
+    async for response in ingest_pdf(texts, namespace):
+        returns.append(response)
+        await report_progress(float(response) / 100, "Upserting embeddings")
+    return returns
 
 class DeterministicFunction(BaseModel):
     response: Any = Field(
@@ -80,67 +121,120 @@ class DeterministicFunction(BaseModel):
 
 def use_auto(app: APIServer):
     @app.sse("/api/functions")
-    async def function_events(sse:EventSourceResponse,namespace:str):
-        queue = FunctionQueue(namespace=namespace)
-        async for event in queue.sub():
-            await sse.send(event)
+    async def function_events(sse:EventSourceResponse,request:Request,namespace:str):
+        async with FunctionQueue.from_request(namespace, request) as queue:
+            await sse_clients.deliver(sse, queue, namespace, on_sent=queue.ack)
 
     @app.post("/api/functions")
-    async def function_endpoint(text:str,namespace:str):
-        await automate(text=text,namespace=namespace)
-        return {"status":"success","message":f"message sent to {namespace}"}
+    async def function_endpoint(request:Request,text:str,namespace:str):
+        """Starts an automation job, `functions` optionally restricts the offered functions to a comma separated list"""
+        functions = requested_functions(request.query.get("functions", ""))
+        try:
+            functions_registry.subset(*functions)
+        except KeyError as exc:
+            raise HTTPBadRequest(text=str(exc)) from exc
+        job = await automate(text=text,namespace=namespace,functions=functions)
+        return {"status":"success","message":f"message sent to {namespace}","job":job}
     
 
     @app.post("/api/content")
     async def create_blogpost(request: GenerateContentRequest,namespace:str):
-        """Creates a blogpost with a cover image from a blog prompt and an image prompt"""
-        bucket_name = "images-aiofauna"
-        blogpost_webpage = BlogPostWebPage(**request.dict())
-        image_url = await CreateImageRequest(prompt=request.image_prompt).run()
-        async with ClientSession() as session:
-            async with session.get(image_url) as resp:  # type: ignore
-                res = await resp.read()
-                id_ = str(uuid4())
-                s3.put_object(
-                    Bucket=bucket_name,
-                    Key=f"{blogpost_webpage.user}/{id_}.png",  # type: ignore
-                    Body=res,
-                    ACL="public-read",
-                    ContentType="image/png",
-                )
-                blogpost_webpage.image = f"https://s3.amazonaws.com/{bucket_name}/{blogpost_webpage.user}/{id_}.png"
-                response = await blogpost_webpage.run()
-                queue = FunctionQueue(namespace=namespace)
-                await queue.pub(message=to_json(response))
-                return {"status":"success","message":f"message sent to {namespace}"}
+        """Starts a blogpost job with a cover image from a blog prompt and an image prompt, returns its id"""
+        job = await generate_blogpost(request.dict(), namespace)
+        return {"status":"success","message":f"message sent to {namespace}","job":job}
 
     @app.get("/api/content")
-    async def list_content(user: str) -> List[BlogPostWebPage]:
-        """List all the content generated by a user"""
+    async def list_content(
+        request: Request, user: str
+    ) -> List[BlogPostWebPage]:
+        """List all the content generated by a user, paged with `after`/`limit` or streamed with `format=ndjson`"""
+        after, limit, format = page_params(request)
+
+        def rendered(response: List[BlogPostWebPage]):
+            for i in response:
+                if i.content is not None:
+                    i.content = render_markdown(i.content)
+            return response
+
+        if format == "ndjson":
+
+            async def rows():
+                async for page in iterate(BlogPostWebPage, after=after, user=user):
+                    for post in rendered(page):
+                        yield post.dict()
+
+            return await stream_ndjson(request, rows())
+        if after or limit:
+            page, cursor = await paginate(BlogPostWebPage, after=after, limit=limit or 50, user=user)
+            return {"data": rendered(page), "after": cursor}  # type: ignore
         response = await BlogPostWebPage.find_many(user=user)
         logger.info(response)
-        for i in response:
-            if i.content is not None:
-                i.content = render_markdown(i.content)
-        return response
+        return rendered(response)
 
     @app.delete("/api/content")
     async def delete_content(id: str) -> bool:
         """Deletes all the content generated by a user"""
         return await BlogPostWebPage.delete(id)
 
+    @app.post("/api/upload/presign")
+    async def presign_upload(request: Request):
+        """Starts a direct upload of content identified by its SHA-256 `hash`.
+
+        Content the user already uploaded returns its existing Upload record. Otherwise the response
+        holds a presigned PUT URL and presigned POST form, the client uploads to either one and then
+        calls /api/upload/complete with the same parameters.
+        """
+        asset = PresignRequest.from_request(request)
+        existing = await Upload.find_unique(key=asset.key)
+        if existing is not None:
+            metrics.incr("uploads.deduplicated")
+            return {"exists": True, "upload": existing.dict()}
+        url = public_url(asset.bucket_name, asset.key)
+        stored = await transfers.head(asset.bucket_name, asset.key)
+        if stored is not None:
+            # Uploaded before but never recorded
+            metrics.incr("uploads.deduplicated")
+            upload = await asset.record(stored["ContentLength"], url)
+            return {"exists": True, "upload": upload.dict()}
+        metrics.incr("uploads.presigned")
+        return {
+            "exists": False,
+            "key": asset.key,
+            "url": url,
+            "put": transfers.presign_put(
+                asset.bucket_name, asset.key, asset.content_type, asset.checksum, env.S3_PRESIGN_EXPIRES
+            ),
+            "post": transfers.presign_post(
+                asset.bucket_name, asset.key, asset.content_type, asset.checksum, asset.size, env.S3_PRESIGN_EXPIRES
+            ),
+            "expires": env.S3_PRESIGN_EXPIRES,
+        }
+
+    @app.post("/api/upload/complete")
+    async def complete_upload(request: Request):
+        """Records the Upload document once the client has uploaded to the presigned target"""
+        asset = PresignRequest.from_request(request)
+        existing = await Upload.find_unique(key=asset.key)
+        if existing is not None:
+            return existing.dict()
+        stored = await transfers.head(asset.bucket_name, asset.key)
+        if stored is None:
+            raise HTTPNotFound(text=f"{asset.key} has not been uploaded to {asset.bucket_name}")
+        upload = await asset.record(stored["ContentLength"], public_url(asset.bucket_name, asset.key))
+        return upload.dict()
+
     @app.post("/api/upload")
     async def upload_image(request: Request):
-        """Uploads an asset to S3"""
+        """Uploads an asset to S3 through the app, /api/upload/presign uploads it directly"""
         asset = await UploadRequest.from_request(request)
-        s3.put_object(
-            Bucket=asset.bucket_name,
-            Key=asset.key,
-            Body=asset.file.file.read(),
+        await transfers.upload_file(
+            asset.bucket_name,
+            asset.key,
+            asset.file.file,
             ACL="public-read",
             ContentType=asset.file.content_type,
         )
-        url = f"https://s3.amazonaws.com/{asset.bucket_name}/{asset.key}"
+        url = public_url(asset.bucket_name, asset.key)
         return await Upload(
             user=asset.user,  # type: ignore
             name=asset.file.filename,  # type: ignore
@@ -153,14 +247,27 @@ def use_auto(app: APIServer):
 
     @app.post("/api/pdf")
     async def upload_pdf(request: Request):
+        """Extracts the PDF text and starts the ingestion job, returns its id"""
         namespace = request.query.get("namespace")
         assert namespace is not None
         responses = []
         async for chunk in pdf_reader(request):
             responses.append(chunk)
-        returns = []
-        async for response in ingest_pdf(responses, namespace):
-            returns.append(response)
-        return returns
+        job = await ingest_document(responses, namespace)
+        return {"status":"success","message":f"ingesting {len(responses)} pages into {namespace}","job":job}
+
+    @app.get("/api/jobs/{id}")
+    async def job_status(id: str):
+        """Returns the status, progress, partial results and result of a job"""
+        state = await jobs.result(id)
+        if state is None:
+            raise HTTPNotFound(text=f"Job {id} not found")
+        return state.dict()
+
+    @app.sse("/api/jobs/{id}/events")
+    async def job_events(sse: EventSourceResponse, id: str):
+        """Streams the job state on every change until it finishes"""
+        updates = ((None, payload) async for payload in jobs.watch(id))
+        await sse_clients.deliver(sse, updates, f"job:{id}")
 
     return app
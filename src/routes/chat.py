@@ -1,9 +1,16 @@
+import time
+
 from aiofauna import APIServer
 from aiohttp.http import WebSocketError
 from aiohttp import ClientConnectionError
+from aiohttp.web import StreamResponse
 
 from ..helpers import *
 from ..helpers.formaters import MarkdownRenderer
+from ..helpers.llm import semantic_cache
+from ..helpers.singleflight import flights
+from ..helpers.sse import sse_clients
+from ..helpers.pagination import iterate, page_params, paginate, stream_ndjson
 from ..routes import *
 from ..schemas import *
 from ..services import *
@@ -39,29 +46,77 @@ AI response:
 """
 )
 
+def title_notifier(namespace: str):
+    """Pushes the generated title to every socket open on the namespace"""
+
+    async def notify(title: str):
+        await sessions.broadcast(namespace, {"type": "title", "content": title})
+
+    return notify
+
+async def single_delta(text: str):
+    yield text
+
 @handle_errors
-async def handle_chat_message(text: str, namespace: str, ws: WebSocketResponse):
-    conversation = await Namespace.get(namespace)
-    if conversation.title == "[New Conversation]":
-        await conversation.set_title(text)
-    context = await ChatMessage.find_many(limit=4, conversation=namespace)
-    response = await llm.chat_with_memory(
+async def handle_chat_message(text: str, namespace: str):
+    cached = await Namespace.context(namespace)
+    conversation = cached.conversation
+    prompt = previous.render(title=conversation.title, messages=cached.window(), default_context=default_context)
+    if conversation.title == NEW_CONVERSATION:
+        await conversation.schedule_title(text, notify=title_notifier(namespace))
+    response = await llm.cached_chat_with_memory(
         text=text,
-        context=previous.render(title=conversation.title, messages=context, default_context=default_context),
+        context=prompt,
         namespace=namespace,
+        scope=llm.cache_scope(namespace=namespace, user=conversation.user),
     )
-    md_response = MarkdownRenderer(response)
-    await md_response.stream(ws)  # type:ignore
-    user_message = await ChatMessage(
-        role="user", content=text, conversation=namespace # type:ignore
-    ).save()  # type:ignore
-    assistant_message = await ChatMessage(
-        role="assistant", content=response, conversation=namespace # type:ignore
-    ).save()  # type:ignore
-    await conversation.update(
-        conversation.ref,
-        messages=conversation.messages
-        + [user_message.ref, assistant_message.ref], # type:ignore
+    await sessions.broadcast(namespace, MarkdownRenderer(response).format())
+    await conversation.save_turn(
+        ChatMessage(role="user", content=text, conversation=namespace),  # type:ignore
+        ChatMessage(role="assistant", content=response, conversation=namespace),  # type:ignore
+    )
+
+@handle_errors
+async def handle_chat_stream(text: str, namespace: str):
+    """Streams completion deltas as they arrive, then one rendered frame"""
+    cached = await Namespace.context(namespace)
+    conversation = cached.conversation
+    prompt = previous.render(title=conversation.title, messages=cached.window(), default_context=default_context)
+    if conversation.title == NEW_CONVERSATION:
+        await conversation.schedule_title(text, notify=title_notifier(namespace))
+    started = time.perf_counter()
+    scope = llm.cache_scope(namespace=namespace, user=conversation.user)
+    cached_answer, embedding = None, None
+    if scope is not None:
+        # Same partition as the non-stream path, follow ups only hit within the same history
+        scope = llm.context_scope(scope, prompt)
+        cached_answer, embedding = await llm.semantic_lookup(text, scope)
+    if cached_answer is not None:
+        deltas = single_delta(cached_answer)
+    else:
+        deltas = llm.chat_stream_with_context(
+            text=text,
+            namespace=namespace,
+            context=prompt,
+            embedding=embedding,
+        )
+    ttft = None
+    chunks = []
+    async for delta in deltas:
+        if ttft is None:
+            ttft = time.perf_counter() - started
+            metrics.observe("chat.ttft", ttft)
+            logger.info(f"Time to first token for {namespace}: {ttft:.3f}s")
+        chunks.append(delta)
+        await sessions.broadcast(namespace, {"type": "delta", "content": delta})
+    response = "".join(chunks)
+    metrics.observe("chat.completion", time.perf_counter() - started)
+    if scope is not None and cached_answer is None:
+        semantic_cache.add(scope, embedding, response)
+    await sessions.broadcast(namespace, {"type": "rendered", "content": MarkdownRenderer(response).format()})
+    await conversation.save_turn(
+        ChatMessage(role="user", content=text, conversation=namespace),  # type:ignore
+        ChatMessage(role="assistant", content=response, conversation=namespace),  # type:ignore
     )
 
 def use_chat(app: APIServer):
@@ -69,13 +124,8 @@ def use_chat(app: APIServer):
     async def auth_endpoint(request: Request):
         """Authenticates a user using Auth0 and saves it to the database"""
         token = request.headers.get("Authorization", "").split("Bearer ")[-1]
-        user_dict = await auth.update_headers({"Authorization": f"Bearer {token}"}).get(
-            "/userinfo"
-        )
-        user = User(**user_dict)
-        response = await user.save()
-        assert isinstance(response, User)
-        return response.dict()
+        user = await auth.user_info(token)
+        return user.dict()
 
     @app.get("/api/conversation/new")
     async def conversation_create(user: str):
@@ -86,74 +136,136 @@ def use_chat(app: APIServer):
     async def conversation_get(id: str):
         conversation = await Namespace.get(id)
         if (
-            conversation.title == "[New Conversation]"
+            conversation.title == NEW_CONVERSATION
             and len(conversation.messages) > 0
         ):
-            first_prompt = (await ChatMessage.find_many(conversation=id))[0]
-            return await conversation.set_title(first_prompt.content)
+            return await conversation.schedule_title()
         return conversation
 
     @app.get("/api/conversation/list")
-    async def conversation_list(user: str):
-        """Lists all conversations for a user"""
+    async def conversation_list(
+        request: Request, user: str
+    ):
+        """Lists all conversations for a user, paged with `after`/`limit` or streamed with `format=ndjson`"""
+        after, limit, format = page_params(request)
+        if format == "ndjson":
+
+            async def rows():
+                async for page in iterate(Namespace, after=after, user=user):
+                    for conversation in page:
+                        yield conversation.dict()
+
+            return await stream_ndjson(request, rows())
+        if after or limit:
+            data, cursor = await paginate(Namespace, after=after, limit=limit or 50, user=user)
+            return {"data": data, "after": cursor}
         return await Namespace.find_many(user=user)
 
     @app.delete("/api/conversation")
     async def conversation_delete(id: str):
         """Deletes a conversation"""
+        conversations.pop(id)
         return await Namespace.delete(id)
 
     @app.post("/api/audio")
-    async def audio_response(text: str, mode: str):
-        """Returns an audio response from a text"""
+    async def audio_response(request: Request, text: str, mode: str):
+        """Returns an audio response from a text, `mode=pipeline` speaks the answer sentence by sentence as it streams"""
         if mode == "llm":
-            response = await llm.chat(
+            response = await llm.cached_chat(
                 text,
-                
-            )
-            polly = Polly.from_text(response)
-            return Response(
-                body=await polly.get_audio(), content_type="application/octet-stream"
+                context=default_context,
+                scope=llm.cache_scope(),
             )
-        return Response(
-            body=await Polly.from_text(text).get_audio(),
-            content_type="application/octet-stream",
-        )
+            return await Polly.from_text(response).respond(request)
+        if mode == "pipeline":
+            response = StreamResponse(headers={"Content-Type": "application/octet-stream"})
+            await response.prepare(request)
+            async for audio in synthesize_pipeline(
+                sentences(llm.chat_stream(text, context=default_context))
+            ):
+                await response.write(audio)
+            await response.write_eof()
+            return response
+        return await Polly.from_text(text).respond(request)
 
     @app.post("/api/messages/list")
     async def post_chat(text: str, namespace: str):
         """Returns a list of messages from a conversation"""
         conversation = await Namespace.get(namespace)
-        if conversation.title == "[New Conversation]":
-            return await conversation.set_title(text)
+        if conversation.title == NEW_CONVERSATION:
+            await conversation.schedule_title(text)
         return await conversation.chat_premium(text)
 
-    @app.get("/api/messages/get")
-    async def get_messages(id: str):
-        """Returns a list of messages from a conversation"""
-        response = await ChatMessage.find_many(conversation=id)
+    async def render_messages(response: List[ChatMessage]):
+        contents = await render_many([message.content for message in response])
         messages = []
-        for message in response:
+        for message, content in zip(response, contents):
             messages.append(
                 {
                     "role": message.role,
-                    "content": markdown(message.content),
+                    "content": content,
                     "ts": message.ts,
                     "ref": message.ref,
                 }
             )
         return messages
 
+    @app.get("/api/messages/get")
+    async def get_messages(
+        request: Request, id: str
+    ):
+        """Returns a list of messages from a conversation, paged with `after`/`limit` or streamed with `format=ndjson`"""
+        after, limit, format = page_params(request)
+        if format == "ndjson":
+
+            async def rows():
+                async for page in iterate(ChatMessage, after=after, conversation=id):
+                    for message in await render_messages(page):
+                        yield message
+
+            return await stream_ndjson(request, rows())
+        if after or limit:
+            page, cursor = await paginate(ChatMessage, after=after, limit=limit or 50, conversation=id)
+            return {"data": await render_messages(page), "after": cursor}
+        return await render_messages(await ChatMessage.find_many(conversation=id))
+
+    @app.get("/api/metrics")
+    async def metrics_endpoint():
+        """Returns the in-process counters, gauges and timings"""
+        return {
+            **metrics.snapshot(),
+            "conversations": conversations.stats(),
+            "sessions": await sessions.stats(),
+            "semantic_cache": semantic_cache.stats(),
+            "singleflight": flights.stats(),
+            "users": users.stats(),
+            "pubsub": broker.stats(),
+            "sse": sse_clients.stats(),
+            "jobs": await jobs.stats(),
+            "functions": functions_registry.stats(),
+            "s3": transfers.stats(),
+        }
+
     @app.websocket("/api/ws")
-    async def ws_endpoint(ws: WebSocketResponse, namespace: str):
-        """Websocket endpoint for chat"""
+    async def ws_endpoint(ws: WebSocketResponse, request: Request, namespace: str):
+        """Websocket endpoint for chat, `mode=stream` sends token deltas before the rendered answer.
+
+        Output is delivered to every socket open on the namespace, across workers,
+        and turns on a namespace are handled one at a time.
+        """
+        mode = request.query.get("mode", "default")
+        handler = handle_chat_stream if mode == "stream" else handle_chat_message
+        connection = await sessions.connect(ws, namespace, json_frames=mode == "stream")
         try:
             while True:
                 text = await ws.receive_str()
-                await handle_chat_message(text, namespace, ws)
+                async with sessions.lock(namespace):
+                    await handler(text, namespace)
         except (ClientConnectionError,WebSocketError, TypeError, ValueError, ConnectionResetError,Exception) as e:
             logger.error(e)
             pass
         finally:
-            await ws.send_str("I'll be waiting for your next message!")
+            await sessions.disconnect(connection)
+            if not ws.closed:
+                await ws.send_str("I'll be waiting for your next message!")
     return app
@@ -3,8 +3,10 @@ from typing import *
 from aiofauna.json import to_json
 from ..schemas.functions import *
 from aiofauna import *
+from aiohttp.web_exceptions import HTTPBadRequest
 from ..services.pubsub import FunctionQueue
-from ..helpers import app
+from ..helpers.registry import functions_registry, requested_functions
+from ..helpers.sse import sse_clients
 
 
 
@@ -12,14 +14,16 @@ from ..helpers import app
 
 def use_zaps(app:APIServer):
 	@app.sse("/api/consumer/{namespace}")
-	async def function_consumer(namespace:str,sse:EventSourceResponse):
-		queue = FunctionQueue(namespace=namespace)
-		async for event in queue.sub():
-			await sse.send(event)
+	async def function_consumer(namespace:str,request:Request,sse:EventSourceResponse):
+		async with FunctionQueue.from_request(namespace, request) as queue:
+			await sse_clients.deliver(sse, queue, namespace, on_sent=queue.ack)
 
 	@app.post("/api/producer")
-	async def function_producer(namespace:str,text:str):
-		queue = FunctionQueue(namespace=namespace)
-		await queue.pub(message=text)
-		return await function_call(text=text,context="You are a function Orchestrator",model="gpt-3.5-turbo-16k-0613")
+	async def function_producer(request:Request,namespace:str,text:str):
+		"""Dispatches `text` once, `functions` optionally restricts the offered functions to a comma separated list."""
+		try:
+			functions = functions_registry.subset(*requested_functions(request.query.get("functions", "")))
+		except KeyError as exc:
+			raise HTTPBadRequest(text=str(exc)) from exc
+		return await FunctionQueue(namespace=namespace).dispatch(text, functions=functions)
 	return app
\ No newline at end of file
@@ -3,14 +3,13 @@ from aiofauna.typedefs import FunctionType
 from aiofauna import FaunaModel
 from typing import *
 from pydantic import BaseModel, Field
-from aiofauna.llm import LLMStack, function_call
+from src.helpers.llm import LLM, function_call
+from src.helpers.plan import Plan
 from src.tools.content import CreateImageRequest
-from src.services import session
-from aiohttp import ClientSession
+from src.services.transfer import transfers
 from uuid import uuid4
 
-llm = LLMStack()
-s3 = session.client("s3", region_name="us-east-1")
+llm = LLM()
 
 class PromptEngineer(FunctionType):
 	"""Emulates a prompts engineer, building multiple prompts from a single prompt to generate a prompt layer data structure"""
@@ -57,22 +56,32 @@ class Post(FaunaModel, FunctionType):
 	content: str = Field(..., description="The content of the blog post")
 	
 	async def run(self):
-		self.title = await llm.chat(text=self.title, context="You are a Blog Post Title Generator")
-		self.subtitle = await llm.chat(text=self.subtitle, context="You are a Blog Post Subtitle Generator")
-		image = await CreateImageRequest(prompt=self.image).run()
-		self.content = await llm.chat(text=self.content, context="You are a Blog Post Content Generator, In Markdown Format")
-		async with ClientSession() as session:
-			async with session.get(image) as resp:  # type: ignore
-				res = await resp.read()
-				id_ = str(uuid4())
-				s3.put_object(
-					Bucket="images-aiofauna",
-					Key=f"{id_}.png",  # type: ignore
-					Body=res,
-					ACL="public-read",
-					ContentType="image/png",
-				)
-				self.image = f"https://s3.amazonaws.com/aiofauna-images/{id_}.png"
-				return await self.save()
-		
-		
\ No newline at end of file
+		id_ = str(uuid4())
+		plan = Plan("post")
+
+		@plan.step()
+		async def title():
+			return await llm.chat(text=self.title, context="You are a Blog Post Title Generator")
+
+		@plan.step()
+		async def subtitle():
+			return await llm.chat(text=self.subtitle, context="You are a Blog Post Subtitle Generator")
+
+		@plan.step()
+		async def content():
+			return await llm.chat(text=self.content, context="You are a Blog Post Content Generator, In Markdown Format")
+
+		@plan.step()
+		async def image():
+			return await CreateImageRequest(prompt=self.image).run()
+
+		@plan.step(after=["image"])
+		async def upload(image: str):
+			await transfers.upload_url(image, "images-aiofauna", f"{id_}.png", ACL="public-read", ContentType="image/png")
+
+		results = await plan.run()
+		self.title = results["title"]
+		self.subtitle = results["subtitle"]
+		self.content = results["content"]
+		self.image = f"https://s3.amazonaws.com/aiofauna-images/{id_}.png"
+		return await self.save()
@@ -1,18 +1,31 @@
 import asyncio
+import functools
 import os
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
 
+import aioredis
 import openai
 from aiofauna import *
-from aiofauna.llm.llm import FunctionType, LLMStack, function_call
+from aiofauna.llm.llm import FunctionType
 from aiofauna.llm.schemas import Message, Role
 from aiofauna.utils import handle_errors, setup_logging
+from pydantic import validator
 from click import style
 from jinja2 import Template
 
 from src.tools.content import CreateImageRequest
 
+from ..config import env
+from ..helpers.cache import LRUCache
+from ..helpers.connections import pool
 from ..helpers.formaters import markdown
+from ..helpers.llm import LLM, function_call
+from ..helpers.pagination import from_document
+from ..helpers.persistence import write_behind
+from ..helpers.plan import Plan
+from ..helpers.tokens import count_tokens, fit_budget
 from ..utils import BackgroundTasks
 
 previous = """
@@ -31,8 +44,10 @@ Previous messages exchanged with {{ user }}:
 """
 
 
+logger = setup_logging(__name__)
+
 BucketType = Literal["images", "audio", "video", "assets", "code"]
-llm = LLMStack(
+llm = LLM(
     base_url=os.environ["PINECONE_URL"],
     headers={"api-key": os.environ["PINECONE_API_KEY"]},
 )
@@ -42,20 +57,173 @@ class ChatMessage(FaunaModel):
     conversation: str = Field(..., description="The conversation id.", index=True)
     role: Role = Field(..., description="The role of the message.")
     content: str = Field(..., description="The content of the message.")
+    tokens: int = Field(default=0, description="Token count of the content.")
+
+    @validator("tokens", always=True)
+    def set_tokens(cls, value, values):  # pylint: disable=no-self-argument
+        return value or count_tokens(values.get("content", ""))
+
+    @classmethod
+    async def recent(cls, conversation: str, limit: int = 4) -> List["ChatMessage"]:
+        """Last `limit` messages of a conversation, oldest first, in one query"""
+        response = await cls.q()(
+            q.map_(
+                q.lambda_("ref", q.get(q.var("ref"))),
+                q.paginate(
+                    q.reverse(q.match(q.index("chatmessage_conversation"), conversation)),
+                    size=limit,
+                ),
+            )
+        )
+        return [from_document(cls, data) for data in reversed(response["data"])]
+
+
+@dataclass
+class ConversationContext:
+    """Conversation metadata and the recent message window used to build prompts"""
+
+    conversation: "Namespace"
+    messages: Deque[ChatMessage]
+    version: Optional[int] = None
+
+    def window(self, budget: Optional[int] = None) -> List[ChatMessage]:
+        """Most recent messages whose stored token counts fit in `budget`"""
+        return fit_budget(
+            self.messages,
+            budget or env.CONTEXT_TOKEN_BUDGET,
+            lambda message: message.tokens,
+        )
+
+
+NEW_CONVERSATION = "[New Conversation]"
+TITLE_PENDING = "[Title Pending]"
+
+title_jobs: Dict[str, "asyncio.Task"] = {}
+
+conversations: LRUCache[ConversationContext] = LRUCache(
+    "conversations", maxsize=env.CONTEXT_CACHE_SIZE, ttl=env.CONTEXT_CACHE_TTL
+)
+
+
+def version_key(ref: str) -> str:
+    return f"ctx:version:{ref}"
+
+
+async def context_version(ref: str) -> Optional[int]:
+    """How many times the conversation changed in Fauna, None when Redis cannot tell"""
+    try:
+        return int(await pool.get(version_key(ref)) or 0)
+    except (aioredis.RedisError, OSError) as exc:
+        logger.warning(f"Could not read the context version of {ref}: {exc!r}")
+        return None
+
+
+async def bump_version(ref: str):
+    """Marks the cached context stale on every other worker once a change is stored in Fauna"""
+    async with pool.pipeline(transaction=False) as pipe:
+        pipe.incr(version_key(ref))
+        pipe.expire(version_key(ref), int(env.CONTEXT_CACHE_TTL))
+        version, _ = await pipe.execute()
+    cached = conversations.peek(ref)
+    # This worker's copy already holds the change, unless another worker changed it in between
+    if cached is not None and cached.version == version - 1:
+        cached.version = version
 
 
 class Namespace(FaunaModel):
     messages: List[str] = Field(default_factory=list)
-    title: str = Field(default="[New Conversation]", index=True)
+    title: str = Field(default=NEW_CONVERSATION, index=True)
     user: str = Field(..., index=True)
 
+    @classmethod
+    async def context(cls, ref: str) -> ConversationContext:
+        """Cached conversation context, loaded from Fauna on a miss or after another worker changed it"""
+        cached = conversations.get(ref)
+        version = await context_version(ref)
+        if cached is not None and (version is None or cached.version == version):
+            return cached
+        conversation, messages = await asyncio.gather(
+            cls.get(ref), ChatMessage.recent(ref, limit=env.CONTEXT_WINDOW)
+        )
+        context = ConversationContext(
+            conversation=conversation,
+            messages=deque(messages, maxlen=env.CONTEXT_WINDOW),
+            version=version,
+        )
+        conversations.set(ref, context)
+        return context
+
+    async def save_turn(self, *messages: ChatMessage):
+        """Queues the messages for persistence and appends them to the cached window"""
+        await write_behind.save_turn(self, *messages, flushed=functools.partial(bump_version, self.ref))
+        cached = conversations.peek(self.ref)
+        if cached is not None:
+            cached.messages.extend(messages)
+
+    async def schedule_title(
+        self,
+        text: Optional[str] = None,
+        notify: Optional[Callable[[str], Awaitable[Any]]] = None,
+    ) -> "Namespace":
+        """Generates the title in the background, at most once per conversation at a time.
+
+        A Redis lock keeps other workers from starting the same job; `notify`
+        receives the title once it is stored. Without `text` the first user
+        message is used as the prompt. The title is optional, so Redis errors
+        never fail the caller.
+        """
+        self.title = TITLE_PENDING
+        cached = conversations.peek(self.ref)
+        if cached is not None:
+            cached.conversation.title = TITLE_PENDING
+        if self.ref in title_jobs:
+            return self
+        try:
+            if not await pool.set(f"title:{self.ref}", 1, nx=True, ex=120):
+                return self
+        except (aioredis.RedisError, OSError) as exc:
+            # Without the lock another worker may generate the title too, which is harmless
+            logger.warning(f"Title lock unavailable for {self.ref}, generating without it: {exc!r}")
+        task = asyncio.create_task(self._generate_title(text, notify))
+        title_jobs[self.ref] = task
+        task.add_done_callback(lambda _: title_jobs.pop(self.ref, None))
+        return self
+
+    async def _generate_title(
+        self, text: Optional[str], notify: Optional[Callable[[str], Awaitable[Any]]]
+    ):
+        try:
+            if text is None:
+                text = (await ChatMessage.find_many(limit=1, conversation=self.ref))[0].content
+            conversation = await self.set_title(text)
+            if notify is not None:
+                await notify(conversation.title)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error(f"Title generation failed for {self.ref}: {exc}")
+            cached = conversations.peek(self.ref)
+            if cached is not None:
+                cached.conversation.title = NEW_CONVERSATION
+        finally:
+            try:
+                await pool.delete(f"title:{self.ref}")
+            except (aioredis.RedisError, OSError) as exc:
+                logger.warning(f"Could not release the title lock of {self.ref}: {exc!r}")
+
     @handle_errors
     async def set_title(self, text: str):
         response = await llm.chat(
             text=text,
             context=f"You are a conversation titles generator, you will generate this conversation title based on the  user first prompt. FIRST PROMPT: {text}",
         )
-        return await self.update(self.ref, title=response)  # type:ignore
+        conversation = await self.update(self.ref, title=response)  # type:ignore
+        cached = conversations.peek(self.ref)
+        if cached is not None:
+            cached.conversation = conversation
+        try:
+            await bump_version(self.ref)
+        except (aioredis.RedisError, OSError) as exc:
+            logger.warning(f"Could not publish the new title of {self.ref}: {exc!r}")
+        return conversation
 
     @handle_errors
     async def chat_with_persistence(
@@ -64,25 +232,23 @@ class Namespace(FaunaModel):
         response = await llm.chat_with_memory(
             text=text, context=context, namespace=self.ref
         )
-        user_message = await ChatMessage(
+        user_message = ChatMessage(
             role="user", content=text, conversation=self.ref  # type:ignore
-        ).save()
-        assistant_message = await ChatMessage(
+        )
+        assistant_message = ChatMessage(
             role="assistant", content=response, conversation=self.ref  # type:ignore
-        ).save()
-        await self.update(
-            self.ref,
-            messages=self.messages
-            + [user_message.ref, assistant_message.ref],  # type:ignore
-        )  # type:ignore
-        return await ChatMessage.find_many(conversation=self.ref)
+        )
+        messages = await ChatMessage.find_many(conversation=self.ref)
+        await self.save_turn(user_message, assistant_message)
+        return messages + [user_message, assistant_message]
 
     @handle_errors
     async def chat_premium(self, text: str):
+        cached = await self.context(self.ref)
         context = Template(previous).render(
             title=self.title,
             user=self.user,
-            messages=(await ChatMessage.find_many(limit=4, conversation=self.ref)),
+            messages=cached.window(),
         )
         return await self.chat_with_persistence(text, context)
 
@@ -102,6 +268,7 @@ class User(FaunaModel):
     picture: Optional[str] = Field(default=None)
     sub: str = Field(..., unique=True)
     updated_at: Optional[str] = Field(default=None)
+    profile_hash: Optional[str] = Field(default=None)
 
 
 class Upload(FaunaModel):
@@ -123,6 +290,9 @@ class Upload(FaunaModel):
         index=True,
     )
     url: Optional[str] = Field(None, description="File url")
+    hash: Optional[str] = Field(
+        default=None, description="SHA-256 of the content, hex encoded", index=True
+    )
 
 
 class DatabaseKey(FaunaModel):
@@ -168,7 +338,18 @@ class BlogPostWebPage(FaunaModel, FunctionType):
     async def run(self):
         return await self.create_content()
 
-    async def create_content(self):
+    async def create_content(self, plan: Optional[Plan] = None):
+        """Writes the post alongside the steps already on `plan` and saves it once all of them are done.
+
+        `image` must already hold the final cover URL, steps producing the image run concurrently with the writing.
+        """
+        plan = plan or Plan("blogpost")
+        plan.add("content", self.write_content)
+        await plan.run()
+        await self.save()
+        return markdown(self.content)
+
+    async def write_content(self) -> str:
         prompt_template = f"""
         System:
         You are an SEO expert and master copywriter, while being proficient writing content in Markdown, you goal is to write a comprehensive, creative and engaging blogpost about the following topic:
@@ -179,5 +360,4 @@ class BlogPostWebPage(FaunaModel, FunctionType):
         AI:
         """
         self.content = await llm.chat(text=self.blog_prompt, context=prompt_template)
-        await self.save()
-        return markdown(self.content)
+        return self.content
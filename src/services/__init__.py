@@ -1,6 +1,6 @@
 import os
 
-from aiofauna.llm.llm import LLMStack
+from ..helpers.llm import LLM
 
 from .auth import *
 from .bucket import *
@@ -8,5 +8,7 @@ from .cloudflare import *
 from .docker import *
 from .speech import *
 from .pubsub import *
+from .sessions import *
+from .transfer import *
 
-llm = LLMStack(base_url=os.environ.get("PINECONE_URL"), headers={"api-key": os.environ.get("PINECONE_KEY")})  # type: ignore
+llm = LLM(base_url=os.environ.get("PINECONE_URL"), headers={"api-key": os.environ.get("PINECONE_KEY")})  # type: ignore
@@ -1,27 +1,128 @@
+import asyncio
+import hashlib
 import json
+import time
 from dataclasses import dataclass, field
 from os import environ
+from typing import Any, Dict, Optional
 
+import jwt
 from aiofauna import *
-from aiohttp.web_exceptions import HTTPException
+from aiofauna.client import APIException
+from aiohttp import ClientError
+from aiohttp.web_exceptions import HTTPException, HTTPUnauthorized
 
+from ..config import env
+from ..helpers.cache import LRUCache
+from ..helpers.metrics import metrics
 from ..schemas.models import User
 
+logger = setup_logging(__name__)
+
+PROFILE_FIELDS = tuple(name for name in User.__fields__ if name not in ("ref", "ts", "profile_hash"))
+
+users: LRUCache[User] = LRUCache("users", maxsize=env.AUTH_CACHE_SIZE, ttl=env.AUTH_CACHE_TTL)
+
+
+def profile_hash(profile: Dict[str, Any]) -> str:
+    payload = json.dumps({key: profile.get(key) for key in PROFILE_FIELDS}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
 
 @dataclass
 class AuthClient(APIClient):
-    async def user_info(self, token: str):
+    jwks: Dict[str, Any] = field(default_factory=dict)
+    jwks_fetched_at: float = field(default=0.0)
+    jwks_retry_at: float = field(default=0.0)
+
+    async def signing_key(self, kid: str):
+        """Key from the cached JWKS, refetched periodically or when an unknown kid shows up"""
+        stale = time.monotonic() - self.jwks_fetched_at > env.JWKS_REFRESH_INTERVAL
+        # An unknown kid only forces a refetch once a minute so bad tokens cannot hammer Auth0
+        rotated = kid not in self.jwks and time.monotonic() - self.jwks_fetched_at > 60
+        if (stale or rotated) and time.monotonic() >= self.jwks_retry_at:
+            try:
+                response = await self.get("/.well-known/jwks.json")
+            except (APIException, ClientError, asyncio.TimeoutError) as exc:
+                logger.warning(f"Could not fetch the JWKS, keeping {len(self.jwks)} cached keys: {exc!r}")
+                metrics.incr("auth.jwks_errors")
+                # Retried after a minute instead of on every request while Auth0 is down
+                self.jwks_retry_at = time.monotonic() + 60
+                return self.jwks.get(kid)
+            assert isinstance(response, dict)
+            self.jwks = {
+                key["kid"]: jwt.PyJWK(key).key for key in response.get("keys", [])
+            }
+            self.jwks_fetched_at = time.monotonic()
+            metrics.incr("auth.jwks_refreshes")
+        return self.jwks.get(kid)
+
+    async def verify(self, token: str) -> Optional[Dict[str, Any]]:
+        """Claims of a JWT signed by the tenant, None for opaque or invalid tokens or when the JWKS is unavailable"""
         try:
-            user_dict = await self.update_headers(
-                {"Authorization": f"Bearer {token}"}
-            ).get("/userinfo")
-            assert isinstance(user_dict, dict)
-            return await User(**user_dict).save()
+            header = jwt.get_unverified_header(token)
+            key = await self.signing_key(header.get("kid", ""))
+            if key is None:
+                return None
+            return jwt.decode(
+                token,
+                key,
+                algorithms=["RS256"],
+                audience=env.AUTH0_AUDIENCE,
+                issuer=f"{self.base_url.rstrip('/')}/",
+                options={"verify_aud": env.AUTH0_AUDIENCE is not None},
+            )
+        except (jwt.PyJWTError, AssertionError, KeyError) as exc:
+            logger.info(f"Local token verification failed: {exc}")
+            return None
+
+    async def userinfo(self, token: str) -> Dict[str, Any]:
+        session = await self.__load__()
+        async with session.get(
+            "/userinfo", headers={"Authorization": f"Bearer {token}"}
+        ) as response:
+            if response.status != 200:
+                raise HTTPUnauthorized(text=await response.text())
+            metrics.incr("auth.userinfo_calls")
+            return await response.json()
+
+    async def sync_user(self, profile: Dict[str, Any]) -> User:
+        """Stored user for the profile, only written when the profile hash changed"""
+        digest = profile_hash(profile)
+        existing = await User.find_unique(sub=profile["sub"])
+        if existing is not None and existing.profile_hash == digest:
+            return existing
+        data = {key: profile.get(key) for key in PROFILE_FIELDS if key in profile}
+        metrics.incr("auth.user_writes")
+        if existing is not None:
+            return await User.update(existing.ref, **data, profile_hash=digest)
+        return await User(**data, profile_hash=digest).save()  # type: ignore
+
+    async def user_info(self, token: str) -> User:
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        cached = users.get(key)
+        if cached is not None:
+            return cached
+        try:
+            claims = await self.verify(token)
+            user = None
+            if claims is not None and "name" in claims:
+                user = await self.sync_user(claims)
+            elif claims is not None:
+                user = await User.find_unique(sub=claims["sub"])
+            if user is None:
+                user = await self.sync_user(await self.userinfo(token))
+            ttl = env.AUTH_CACHE_TTL
+            if claims is not None and "exp" in claims:
+                ttl = min(ttl, claims["exp"] - time.time())
+            if ttl > 0:
+                users.set(key, user, ttl=ttl)
+            return user
 
         except (AssertionError, HTTPException) as exc:
-            return HTTPException(
+            raise HTTPUnauthorized(
                 text=json.dumps({"status": "error", "message": str(exc)})
-            )
+            ) from exc
 
 
 auth = AuthClient(
@@ -1,9 +1,10 @@
+import base64
 from typing import *
 
 from aiofauna.utils import handle_errors
-from aiohttp.web import FileField, Request
+from aiohttp.web import FileField, HTTPBadRequest, Request
 from boto3 import Session
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from pydantic import BaseModel, ValidationError  # pylint: disable=no-name-in-module
 from pydantic import Field as Data  # pylint: disable=no-name-in-module
 
 from ..config import credentials, env
@@ -54,3 +55,59 @@ class UploadRequest(BaseModel):
             file=file,
         )
         return obj
+
+
+class PresignRequest(BaseModel):
+    """
+    PresignRequest
+        - user:str
+        - bucket:BucketType
+        - name:str
+        - size:int
+        - content_type:str
+        - hash:str, hex encoded SHA-256 of the content
+    """
+
+    user: str = Data(...)
+    bucket: BucketType = Data(...)
+    name: str = Data(...)
+    size: int = Data(..., gt=0)
+    content_type: str = Data(...)
+    hash: str = Data(..., regex="^[0-9a-f]{64}$")
+
+    @property
+    def key(self):
+        # Identical content from the same user always lands on the same key
+        return f"{self.user}/{self.hash}"
+
+    @property
+    def bucket_name(self):
+        return f"aiofauna-{self.bucket}"
+
+    @property
+    def checksum(self):
+        """The hash in the base64 form S3 checksums use"""
+        return base64.b64encode(bytes.fromhex(self.hash)).decode("utf-8")
+
+    @classmethod
+    def from_request(cls, request: Request):
+        try:
+            return cls.parse_obj(dict(request.query))
+        except ValidationError as exc:
+            raise HTTPBadRequest(text=str(exc)) from exc
+
+    async def record(self, size: int, url: str) -> "Upload":
+        """Saves the Upload document of the object stored under `key`"""
+        # Imported here, `schemas` is still loading when the services package is first imported
+        from ..schemas.models import Upload
+
+        return await Upload(
+            user=self.user,  # type: ignore
+            name=self.name,  # type: ignore
+            key=self.key,  # type: ignore
+            bucket=self.bucket,  # type: ignore
+            size=size,  # type: ignore
+            content_type=self.content_type,  # type: ignore
+            url=url,  # type: ignore
+            hash=self.hash,  # type: ignore
+        ).save()
@@ -1,58 +1,477 @@
-from typing import AsyncGenerator, TypeVar
+import asyncio
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set, Tuple, TypeVar
+from uuid import uuid4
 import aioredis
-from aioredis.client import PubSub
+from aiohttp.web import Request
 from aiofauna.json import to_json
-from aiofauna.typedefs import LazyProxy
 from aiofauna.utils import setup_logging, handle_errors
-from aiofauna.llm import function_call
 from ..config import env
+from ..helpers.connections import pool
+from ..helpers.llm import function_call
+from ..helpers.metrics import metrics
+from ..helpers.registry import FunctionSet
 
 T = TypeVar("T")
 
+Event = Tuple[Optional[str], str]
+
 logger = setup_logging(__name__)
 
-pool = aioredis.Redis.from_url(env.REDIS_URL)
+class Broker(ABC):
+	"""Publishes channel messages and fans them out to in-process client queues."""
 
-class FunctionQueue(LazyProxy[PubSub]):
-	def __init__(self, namespace: str):
-		"""Initializes a new FunctionQueue Event Stream to catch function call event results in an asynchronous fashion."""
-		self.namespace = namespace
-		logger.info(f"Initializing state for {namespace}")
-		self.ps = self.__load__()
+	durable = False
 
+	def __init__(self, queue_size: int = 256):
+		self.queues: Dict[str, Set["asyncio.Queue[Event]"]] = defaultdict(set)
+		self.locks: Dict[str, asyncio.Lock] = {}
+		self.queue_size = queue_size
+		self.received = 0
+		self.published = 0
+		self.dropped = 0
 
-	def __load__(self):
-		"""Lazy loading of the PubSub object."""
-		return pool.pubsub()
 
-	
-	async def sub(self) -> AsyncGenerator[str, None]:
-		"""Subscribes to the PubSub channel and yields messages as they come in."""
-		await self.ps.subscribe(self.namespace)
-		logger.info(f"Subscribed to {self.namespace}")
-		async for message in self.ps.listen():
+	def lock(self, channel: str) -> asyncio.Lock:
+		"""Serializes subscribe and unsubscribe commands for one channel."""
+		return self.locks.setdefault(channel, asyncio.Lock())
+
+
+	async def subscribe(self, channel: str) -> "asyncio.Queue[Event]":
+		"""Registers a client queue on `channel`, attaching the broker to it on first use."""
+		queue: "asyncio.Queue[Event]" = asyncio.Queue(maxsize=self.queue_size)
+		async with self.lock(channel):
+			if not self.queues[channel]:
+				await self._attach(channel)
+			self.queues[channel].add(queue)
+		metrics.gauge(f"{self.name}.clients", self.clients())
+		return queue
+
+
+	async def unsubscribe(self, channel: str, queue: "asyncio.Queue[Event]") -> None:
+		"""Removes a client queue, detaching the broker from the channel when it was the last one."""
+		async with self.lock(channel):
+			self.queues[channel].discard(queue)
+			if not self.queues[channel]:
+				del self.queues[channel]
+				await self._detach(channel)
+		metrics.gauge(f"{self.name}.clients", self.clients())
+
+
+	def fan_out(self, channel: str, event: Event) -> None:
+		"""Queues the event for every client on the channel, a client that lags loses its oldest events."""
+		self.received += 1
+		for queue in list(self.queues.get(channel, ())):
+			if queue.full():
+				queue.get_nowait()
+				self.dropped += 1
+				metrics.incr(f"{self.name}.dropped")
+			queue.put_nowait(event)
+
+
+	async def publish(self, channel: str, message: str) -> None:
+		await self.publish_many(channel, [message])
+
+
+	@abstractmethod
+	async def publish_many(self, channel: str, messages: List[str]) -> None:
+		"""Publishes every message in order, in as few round-trips as the broker allows."""
+
+
+	@abstractmethod
+	async def _attach(self, channel: str) -> None:
+		...
+
+
+	@abstractmethod
+	async def _detach(self, channel: str) -> None:
+		...
+
+
+	@property
+	def name(self) -> str:
+		return type(self).__name__.lower()
+
+
+	def clients(self) -> int:
+		return sum(len(queues) for queues in self.queues.values())
+
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			"broker": self.name,
+			"channels": len(self.queues),
+			"clients": self.clients(),
+			"published": self.published,
+			"received": self.received,
+			"dropped": self.dropped,
+		}
+
+
+class MemoryBroker(Broker):
+	"""Single-process broker on asyncio queues, for tests and load tests without a Redis server."""
+
+	async def publish_many(self, channel: str, messages: List[str]) -> None:
+		for message in messages:
+			self.fan_out(channel, (None, message))
+		self.published += len(messages)
+
+
+	async def _attach(self, channel: str) -> None:
+		pass
+
+
+	async def _detach(self, channel: str) -> None:
+		pass
+
+
+class RedisBroker(Broker):
+	"""Redis pub/sub with one subscriber connection per worker, demultiplexed to the client queues."""
+
+	def __init__(self, queue_size: int = 256):
+		super().__init__(queue_size)
+		self.ps = pool.pubsub()
+		self.reader: Optional["asyncio.Task[None]"] = None
+
+
+	async def publish(self, channel: str, message: str) -> None:
+		await pool.publish(channel, message)
+		self.published += 1
+
+
+	async def publish_many(self, channel: str, messages: List[str]) -> None:
+		async with pool.pipeline(transaction=False) as pipe:
+			for message in messages:
+				pipe.publish(channel, message)
+			await pipe.execute()
+		self.published += len(messages)
+
+
+	async def _attach(self, channel: str) -> None:
+		await self.ps.subscribe(channel)
+		logger.info(f"Subscribed to {channel}")
+		if self.reader is None:
+			self.reader = asyncio.create_task(self._read())
+
+
+	async def _detach(self, channel: str) -> None:
+		await self.ps.unsubscribe(channel)
+		logger.info(f"Unsubscribed from {channel}")
+
+
+	async def _read(self) -> None:
+		delay = 1.0
+		while True:
 			try:
-				data = message["data"]
-				yield data.decode("utf-8")
-			except (KeyError, AssertionError, UnicodeDecodeError, AttributeError):
+				message = await self.ps.get_message(ignore_subscribe_messages=True, timeout=1.0)
+			except asyncio.CancelledError:
+				raise
+			except Exception as exc:  # pylint: disable=broad-except
+				# The reader is shared by every client on this worker, it must outlive any error
+				logger.error(f"Subscriber connection lost, retrying in {delay:.0f}s: {exc!r}")
+				metrics.incr(f"{self.name}.reader_errors")
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, 30.0)
+				continue
+			delay = 1.0
+			if message is None:
+				continue
+			try:
+				channel = message["channel"].decode("utf-8")
+				data = message["data"].decode("utf-8")
+			except (KeyError, UnicodeDecodeError, AttributeError):
 				logger.error(f"Invalid message received: {message}")
 				continue
+			self.fan_out(channel, (None, data))
+
+
+def stream_key(namespace: str) -> str:
+	return f"functions:{namespace}"
+
+
+def stream_id(event_id: str) -> Tuple[int, ...]:
+	return tuple(int(part) for part in event_id.split("-"))
+
+
+def decode_entries(entries: List[Any]) -> List[Event]:
+	"""Events from raw stream entries, skipping entries trimmed from the stream since they were read."""
+	events = []
+	for event_id, fields in entries or []:
+		if not fields:
+			continue
+		if isinstance(fields, list):
+			fields = dict(zip(fields[::2], fields[1::2]))
+		events.append((event_id.decode("utf-8"), fields[b"data"].decode("utf-8")))
+	return events
+
+
+class StreamBroker(Broker):
+	"""Capped Redis Streams per channel, read by one blocking XREAD per worker over every followed stream."""
+
+	durable = True
+
+	def __init__(self, maxlen: int = 1000, claim_idle: float = 60, queue_size: int = 256):
+		super().__init__(queue_size)
+		self.maxlen = maxlen
+		self.claim_idle = claim_idle
+		self.cursors: Dict[str, str] = {}
+		self.active = asyncio.Event()
+		self.reader: Optional["asyncio.Task[None]"] = None
+
+
+	async def publish(self, channel: str, message: str) -> None:
+		await pool.xadd(stream_key(channel), {"data": message}, maxlen=self.maxlen, approximate=True)
+		self.published += 1
+
+
+	async def publish_many(self, channel: str, messages: List[str]) -> None:
+		async with pool.pipeline(transaction=False) as pipe:
+			for message in messages:
+				pipe.xadd(stream_key(channel), {"data": message}, maxlen=self.maxlen, approximate=True)
+			await pipe.execute()
+		self.published += len(messages)
+
+
+	async def _attach(self, channel: str) -> None:
+		"""Follows the stream from its current tail."""
+		latest = await pool.xrevrange(stream_key(channel), count=1)
+		self.cursors[channel] = latest[0][0].decode("utf-8") if latest else "0-0"
+		self.active.set()
+		if self.reader is None:
+			self.reader = asyncio.create_task(self._read())
+
+
+	async def _detach(self, channel: str) -> None:
+		self.cursors.pop(channel, None)
+		if not self.cursors:
+			self.active.clear()
+
+
+	async def replay(self, channel: str, last_event_id: str) -> List[Event]:
+		"""Entries after `last_event_id` that are still retained on the channel stream."""
+		try:
+			entries = await pool.xrange(stream_key(channel), min=last_event_id, max="+")
+		except aioredis.ResponseError as exc:
+			logger.error(f"Invalid Last-Event-ID {last_event_id}: {exc}")
+			return []
+		events = [
+			(event_id.decode("utf-8"), fields[b"data"].decode("utf-8"))
+			for event_id, fields in entries
+		]
+		metrics.incr("streams.replayed", len(events))
+		return [event for event in events if event[0] != last_event_id]
+
+
+	async def consume(self, channel: str, group: str, consumer: Optional[str] = None) -> AsyncGenerator[Event, None]:
+		"""Reads the channel stream as `consumer` of a consumer group, entries stay pending until `ack`.
+
+		A consumer reconnecting under the same name first gets its own pending entries again, then the
+		entries other consumers left pending for longer than `claim_idle`, then new entries.
+		"""
+		key = stream_key(channel)
+		consumer = consumer or uuid4().hex
+		try:
+			await pool.xgroup_create(key, group, id="$", mkstream=True)
+		except aioredis.ResponseError as exc:
+			if "BUSYGROUP" not in str(exc):
+				raise
+		await self.prune(key, group)
+		try:
+			response = await pool.xreadgroup(group, consumer, {key: "0"}, count=self.maxlen)
+			for _, entries in response or []:
+				for event in decode_entries(entries):
+					yield event
+			async for event in self.claim(key, group, consumer):
+				yield event
+			while True:
+				response = await pool.xreadgroup(group, consumer, {key: ">"}, count=10, block=5000)
+				for _, entries in response or []:
+					for event in decode_entries(entries):
+						yield event
+		finally:
+			await self.leave(key, group, consumer)
+
+
+	async def claim(self, key: str, group: str, consumer: str) -> AsyncGenerator[Event, None]:
+		"""Takes over the entries left pending by consumers that went away (XAUTOCLAIM, Redis 6.2+)."""
+		start = "0-0"
+		while True:
+			response = await pool.execute_command(
+				"XAUTOCLAIM", key, group, consumer, int(self.claim_idle * 1000), start, "COUNT", 100
+			)
+			start, entries = response[0], response[1]
+			claimed = decode_entries(entries)
+			metrics.incr("streams.claimed", len(claimed))
+			for event in claimed:
+				yield event
+			if start in (b"0-0", "0-0"):
+				return
+
+
+	async def ack(self, channel: str, group: str, event_id: str) -> None:
+		await pool.xack(stream_key(channel), group, event_id)
+
+
+	async def leave(self, key: str, group: str, consumer: str) -> None:
+		"""Removes a disconnecting consumer unless it still holds entries another consumer must claim."""
+		try:
+			pending = await pool.xpending_range(key, group, min="-", max="+", count=1, consumername=consumer)
+			if not pending:
+				await pool.xgroup_delconsumer(key, group, consumer)
+		except (aioredis.RedisError, OSError) as exc:
+			logger.error(f"Could not remove consumer {consumer} from {group}: {exc}")
+
+
+	async def prune(self, key: str, group: str) -> None:
+		"""Deletes consumers of the group that hold no pending entries and have been idle past `claim_idle`."""
+		for info in await pool.xinfo_consumers(key, group):
+			name = info.get("name")
+			if info.get("pending") == 0 and info.get("idle", 0) > self.claim_idle * 1000:
+				await pool.xgroup_delconsumer(key, group, name)
+				metrics.incr("streams.pruned")
+
+
+	async def _read(self) -> None:
+		delay = 1.0
+		while True:
+			await self.active.wait()
+			streams = {stream_key(channel): cursor for channel, cursor in self.cursors.items()}
+			try:
+				# The block timeout bounds how long a newly added stream waits to join the read
+				response = await pool.xread(streams, count=100, block=1000)
+			except asyncio.CancelledError:
+				raise
+			except Exception as exc:  # pylint: disable=broad-except
+				logger.error(f"Stream reader connection lost, retrying in {delay:.0f}s: {exc!r}")
+				metrics.incr(f"{self.name}.reader_errors")
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, 30.0)
+				continue
+			delay = 1.0
+			for key, entries in response or []:
+				channel = key.decode("utf-8")[len("functions:"):]
+				for event_id, fields in entries:
+					try:
+						event = (event_id.decode("utf-8"), fields[b"data"].decode("utf-8"))
+					except (KeyError, UnicodeDecodeError, AttributeError):
+						logger.error(f"Invalid stream entry {event_id!r} on {channel}")
+						event = None
+					if channel in self.cursors:
+						self.cursors[channel] = event_id.decode("utf-8")
+					if event is not None:
+						self.fan_out(channel, event)
+
+
+def create_broker(backend: str) -> Broker:
+	"""Broker for a FUNCTION_QUEUE_BACKEND value: `pubsub`, `streams` or `memory`."""
+	if backend == "streams":
+		return StreamBroker(
+			maxlen=env.FUNCTION_STREAM_MAXLEN,
+			claim_idle=env.FUNCTION_STREAM_CLAIM_IDLE,
+			queue_size=env.FUNCTION_QUEUE_SIZE,
+		)
+	if backend == "memory":
+		return MemoryBroker(env.FUNCTION_QUEUE_SIZE)
+	return RedisBroker(env.FUNCTION_QUEUE_SIZE)
+
+
+broker = create_broker(env.FUNCTION_QUEUE_BACKEND)
+
+
+class FunctionQueue(object):
+	def __init__(self, namespace: str, last_event_id: Optional[str] = None, group: Optional[str] = None, consumer: Optional[str] = None, backend: Optional[Broker] = None):
+		"""Initializes a new FunctionQueue Event Stream to catch function call event results in an asynchronous fashion.
+
+		With a durable (`streams`) broker, `last_event_id` replays retained results the client missed and
+		`group` makes consumers of the same group share the results instead of each receiving all of them.
+		A `consumer` name that stays the same across reconnections gets its unacknowledged results back.
+		"""
+		self.namespace = namespace
+		self.backend = backend or broker
+		self.last_event_id = last_event_id if self.backend.durable else None
+		self.group = group if self.backend.durable else None
+		self.consumer = consumer
+		self.queue: Optional["asyncio.Queue[Event]"] = None
+
+
+	@classmethod
+	def from_request(cls, namespace: str, request: Request) -> "FunctionQueue":
+		"""FunctionQueue resuming from the SSE `Last-Event-ID` header and joining the `group` query parameter as `consumer`."""
+		return cls(
+			namespace,
+			last_event_id=request.headers.get("Last-Event-ID") or None,
+			group=request.query.get("group") or None,
+			consumer=request.query.get("consumer") or None,
+		)
+
+
+	async def __aenter__(self) -> "FunctionQueue":
+		if self.group is None:
+			self.queue = await self.backend.subscribe(self.namespace)
+		return self
+
+
+	async def __aexit__(self, *args: Any) -> None:
+		if self.queue is not None:
+			await self.backend.unsubscribe(self.namespace, self.queue)
+			self.queue = None
+
+
+	async def __aiter__(self) -> AsyncGenerator[Event, None]:
+		if self.group is not None:
+			events = self.backend.consume(self.namespace, self.group, self.consumer)  # type: ignore
+			try:
+				async for event in events:
+					yield event
 			finally:
-				await self.ps.unsubscribe(self.namespace)
+				# Closed right away so the consumer leaves the group when the client goes
+				await events.aclose()
+			return
+		assert self.queue is not None, "FunctionQueue must be entered before iterating"
+		last = None
+		if self.last_event_id:
+			for event in await self.backend.replay(self.namespace, self.last_event_id):  # type: ignore
+				last = stream_id(event[0])  # type: ignore
+				yield event
+		while True:
+			event_id, data = await self.queue.get()
+			# Results that arrived while replaying are already delivered
+			if last is not None and event_id is not None and stream_id(event_id) <= last:
+				continue
+			yield event_id, data
+
+
+	async def ack(self, event: Event) -> None:
+		"""Acknowledges a group result once the client received it, other results need no acknowledgement."""
+		if self.group is not None and event[0] is not None:
+			await self.backend.ack(self.namespace, self.group, event[0])  # type: ignore
+
+
+	async def sub(self) -> AsyncGenerator[str, None]:
+		"""Yields messages on the namespace for as long as the caller keeps iterating."""
+		async with self:
+			async for event in self:
+				yield event[1]
+				await self.ack(event)
+
+
+	async def publish(self, message: str) -> None:
+		"""Publishes an already computed payload as is."""
+		await self.backend.publish(self.namespace, message)
+		metrics.incr("pubsub.published")
 
 
-	async def _send(self, message: str) -> None:
-		"""Protected method to send a message to the PubSub channel."""
-		logger.info(f"Sending message to {self.namespace}")
-		await pool.publish(self.namespace, message)
-		await self.ps.unsubscribe(self.namespace)
+	async def publish_many(self, messages: List[str]) -> None:
+		"""Publishes every payload in one pipelined round-trip."""
+		await self.backend.publish_many(self.namespace, messages)
+		metrics.incr("pubsub.published", len(messages))
 
 
-	async def pub(self, message:str)->None:
-		"""Public method to send a function call result to the PubSub channel."""
-		response = await function_call(text=message,context="You are a function Orchestrator",model="gpt-3.5-turbo-16k-0613")
+	async def dispatch(self, text: str, functions: Optional[FunctionSet] = None) -> Any:
+		"""Runs `text` through the function orchestrator, publishes the result and returns it."""
+		response = await function_call(text=text,context="You are a function Orchestrator",model="gpt-3.5-turbo-16k-0613",functions=functions)
 		logger.info(f"Function call result: {response}")
-		await self._send(to_json(response))
+		await self.publish(to_json(response))
 		logger.info(f"Message sent to {self.namespace}")
-		await self.ps.unsubscribe(self.namespace)
-		logger.info(f"Unsubscribed from {self.namespace})")
+		return response
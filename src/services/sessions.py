@@ -0,0 +1,243 @@
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Set, Union
+from uuid import uuid4
+
+from aiofauna import WebSocketResponse
+from aiofauna.utils import setup_logging
+from aioredis.exceptions import LockError, RedisError
+from aioredis.lock import Lock
+
+from ..config import env
+from ..helpers.connections import pool
+from ..helpers.metrics import metrics
+
+logger = setup_logging(__name__)
+
+WORKER_ID = uuid4().hex
+
+Frame = Union[str, Dict[str, Any]]
+
+
+class Connection(object):
+    """A socket with a bounded send queue drained by its own writer task.
+
+    Only clients that opted into JSON frames get them, the others receive rendered answers as plain text.
+    """
+
+    def __init__(self, ws: WebSocketResponse, namespace: str, maxsize: int, policy: str, json_frames: bool = False):
+        self.ws = ws
+        self.namespace = namespace
+        self.policy = policy
+        self.json_frames = json_frames
+        self.queue: "asyncio.Queue[Frame]" = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self.writer = asyncio.create_task(self._write())
+
+    def adapt(self, frame: Frame) -> Optional[Frame]:
+        """`frame` in the form this client reads, None when a text client has no use for it"""
+        if self.json_frames:
+            return frame if isinstance(frame, dict) else {"type": "rendered", "content": frame}
+        if isinstance(frame, str):
+            return frame
+        if frame.get("type") == "rendered":
+            return frame["content"]
+        return None
+
+    def send(self, frame: Frame) -> bool:
+        """Queues a frame without waiting, applying the overflow policy when the client lags"""
+        adapted = self.adapt(frame)
+        if adapted is None:
+            return True
+        frame = adapted
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == "close":
+                logger.warning(f"Closing slow client on {self.namespace}")
+                metrics.incr("ws.closed_slow")
+                asyncio.create_task(self.ws.close(code=1013, message=b"Client too slow"))
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(frame)
+            self.dropped += 1
+            metrics.incr("ws.dropped")
+            return True
+
+    async def _write(self):
+        while not self.ws.closed:
+            frame = await self.queue.get()
+            try:
+                if isinstance(frame, str):
+                    await self.ws.send_str(frame)
+                else:
+                    await self.ws.send_json(frame)
+            except (ConnectionResetError, RuntimeError) as exc:
+                logger.error(exc)
+                break
+
+    async def ping(self):
+        """Protocol-level keepalive, it never shows up in the client's message stream"""
+        try:
+            await self.ws.ping()
+        except (ConnectionResetError, RuntimeError) as exc:
+            logger.warning(f"Ping to a client on {self.namespace} failed: {exc}")
+
+    async def close(self):
+        self.writer.cancel()
+
+
+class SessionManager(object):
+    """Tracks sockets per namespace and fans frames out to every worker through Redis"""
+
+    def __init__(self, maxsize: int = 256, policy: str = "drop", heartbeat: float = 20, lease: float = 30):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.heartbeat = heartbeat
+        self.lease = lease
+        self.connections: Dict[str, Set[Connection]] = defaultdict(set)
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self._tasks: Optional[list] = None
+
+    def start(self):
+        if self._tasks is None:
+            self._tasks = [
+                asyncio.create_task(self._listen()),
+                asyncio.create_task(self._heartbeat()),
+            ]
+
+    async def connect(self, ws: WebSocketResponse, namespace: str, json_frames: bool = False) -> Connection:
+        self.start()
+        connection = Connection(ws, namespace, self.maxsize, self.policy, json_frames)
+        self.connections[namespace].add(connection)
+        try:
+            await pool.hincrby("ws:connections", namespace, 1)
+        except BaseException:
+            await self.forget(connection)
+            raise
+        metrics.gauge("ws.connections", self.count())
+        return connection
+
+    async def forget(self, connection: Connection):
+        """Stops the writer and drops the connection from this worker's registry"""
+        await connection.close()
+        namespace = connection.namespace
+        self.connections[namespace].discard(connection)
+        if not self.connections[namespace]:
+            del self.connections[namespace]
+            lock = self.locks.get(namespace)
+            if lock is not None and not lock.locked():
+                del self.locks[namespace]
+
+    async def disconnect(self, connection: Connection):
+        await self.forget(connection)
+        namespace = connection.namespace
+        try:
+            if await pool.hincrby("ws:connections", namespace, -1) <= 0:
+                await pool.hdel("ws:connections", namespace)
+        except (RedisError, OSError) as exc:
+            logger.error(f"Could not update the connection count of {namespace}: {exc!r}")
+        metrics.gauge("ws.connections", self.count())
+
+    @asynccontextmanager
+    async def lock(self, namespace: str) -> AsyncIterator[None]:
+        """Held for the duration of a chat turn so turns in one namespace never interleave, on any worker.
+
+        Sockets on this worker queue on a local lock first, the turn then takes a Redis lease that is
+        renewed while it runs, so a crashed worker frees the namespace after `lease` seconds.
+        """
+        async with self.locks.setdefault(namespace, asyncio.Lock()):
+            lock = pool.lock(f"ws:turn:{namespace}", timeout=self.lease, sleep=0.05, thread_local=False)
+            await lock.acquire()
+            renew = asyncio.create_task(self._renew(lock, namespace))
+            try:
+                yield
+            finally:
+                renew.cancel()
+                try:
+                    await lock.release()
+                except LockError as exc:
+                    logger.warning(f"Turn lease on {namespace} was lost before release: {exc}")
+
+    async def _renew(self, lock: Lock, namespace: str):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await lock.reacquire()
+            except LockError as exc:
+                logger.error(f"Could not renew the turn lease on {namespace}: {exc}")
+                return
+
+    def deliver(self, namespace: str, frame: Frame):
+        for connection in list(self.connections.get(namespace, ())):
+            connection.send(frame)
+
+    async def broadcast(self, namespace: str, frame: Frame):
+        """Sends a frame to every socket on `namespace`, on this worker and the others"""
+        self.deliver(namespace, frame)
+        await pool.publish(
+            f"ws:{namespace}", json.dumps({"origin": WORKER_ID, "frame": frame})
+        )
+
+    async def _listen(self):
+        """Delivers frames broadcast by the other workers, resubscribing with backoff when Redis drops"""
+        delay = 1.0
+        while True:
+            pubsub = pool.pubsub()
+            try:
+                await pubsub.psubscribe("ws:*")
+                async for message in pubsub.listen():
+                    delay = 1.0
+                    if message["type"] == "pmessage":
+                        self._receive(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error(f"Fan-out subscription lost, resubscribing in {delay:.0f}s: {exc!r}")
+                metrics.incr("ws.resubscribed")
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+    def _receive(self, message: Dict[str, Any]):
+        try:
+            payload = json.loads(message["data"])
+            if payload["origin"] == WORKER_ID:
+                return
+            self.deliver(message["channel"].decode("utf-8")[3:], payload["frame"])
+        except (KeyError, ValueError, UnicodeDecodeError) as exc:
+            logger.error(f"Invalid fan-out message: {exc}")
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            connections = [connection for group in self.connections.values() for connection in list(group)]
+            await asyncio.gather(*(connection.ping() for connection in connections))
+
+    def count(self) -> int:
+        return sum(len(connections) for connections in self.connections.values())
+
+    async def stats(self) -> Dict[str, Any]:
+        cluster = await pool.hgetall("ws:connections")
+        return {
+            "worker": WORKER_ID,
+            "local": self.count(),
+            "namespaces": {
+                key.decode("utf-8"): int(value) for key, value in cluster.items()
+            },
+        }
+
+
+sessions = SessionManager(
+    maxsize=env.WS_QUEUE_SIZE,
+    policy=env.WS_OVERFLOW,
+    heartbeat=env.WS_HEARTBEAT,
+    lease=env.WS_TURN_LEASE,
+)
@@ -1,11 +1,32 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
 from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import List, Literal, Optional
+from typing import AsyncGenerator, AsyncIterable, List, Literal, Optional
 
 from aiofauna import asyncify
+from aiofauna.utils import setup_logging
+from aiohttp.web import FileResponse, Request, StreamResponse
 from boto3 import Session
 from pydantic import BaseModel, Field
 
+from ..config import env
+from ..helpers.metrics import metrics
+
+logger = setup_logging(__name__)
+
+CHUNK_SIZE = 16 * 1024
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+executor = ThreadPoolExecutor(max_workers=env.POLLY_WORKERS)
+
 LanguageCodeType = Literal[
     "arb",
     "cmn-CN",
@@ -48,6 +69,79 @@ LanguageCodeType = Literal[
 ]
 
 
+@functools.lru_cache(maxsize=None)
+def get_client(service: str):
+    """One boto3 client per service for the whole process, boto3 clients are thread safe"""
+    return Session().client(service, region_name="us-east-1")
+
+
+class AudioCache(object):
+    """Content addressed synthesis cache, a size bounded local disk tier backed by an optional S3 bucket"""
+
+    def __init__(self, directory: str, max_bytes: int, bucket: Optional[str] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.bucket = bucket
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Path of the cached audio, pulled from S3 into the disk tier if needed"""
+        path = self.path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            metrics.incr("polly.cache.disk_hits")
+            return path
+        if self.bucket is not None:
+            try:
+                get_client("s3").download_file(self.bucket, key, f"{path}.part")
+                os.replace(f"{path}.part", path)
+                metrics.incr("polly.cache.s3_hits")
+                self.evict()
+                return path
+            except Exception:  # pylint: disable=broad-except
+                pass
+        metrics.incr("polly.cache.misses")
+        return None
+
+    def commit(self, key: str, tmp_path: str):
+        """Moves a finished synthesis into the cache and mirrors it to S3"""
+        path = self.path(key)
+        os.replace(tmp_path, path)
+        self.evict()
+        if self.bucket is not None:
+            try:
+                get_client("s3").upload_file(path, self.bucket, key)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error(f"Could not mirror {key} to S3: {exc}")
+
+    def evict(self):
+        """Removes least recently used files until the disk tier fits `max_bytes`"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                continue
+            stat = os.stat(self.path(name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(self.path(name))
+            total -= size
+            metrics.incr("polly.cache.evictions")
+        metrics.gauge("polly.cache.bytes", total)
+
+
+audio_cache = AudioCache(
+    directory=env.POLLY_CACHE_DIR,
+    max_bytes=env.POLLY_CACHE_MAX_BYTES,
+    bucket=env.POLLY_CACHE_BUCKET,
+)
+
+
 class Polly(BaseModel):
     Engine: Literal["standard", "neural"] = Field(
         default="standard",
@@ -89,15 +183,71 @@ class Polly(BaseModel):
 
     @property
     def client(self):
-        return Session().client("polly", region_name="us-east-1")
+        return get_client("polly")
 
     @property
     def executor(self):
-        return ThreadPoolExecutor()
+        return executor
+
+    @property
+    def key(self) -> str:
+        """Hash of every parameter that changes the synthesized output"""
+        payload = json.dumps(self.dict(exclude_none=True), sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
     def synthesize(self):
         return self.client.synthesize_speech(**self.dict(exclude_none=True))
 
+    async def stream(self) -> AsyncGenerator[bytes, None]:
+        """Yields audio chunks as Polly produces them, teeing them into the cache"""
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, self.synthesize)
+        stream = response["AudioStream"]
+        fd, tmp_path = tempfile.mkstemp(dir=audio_cache.directory, suffix=".part")
+        completed = False
+
+        def read_chunk(file):
+            chunk = stream.read(CHUNK_SIZE)
+            file.write(chunk)
+            return chunk
+
+        try:
+            with os.fdopen(fd, "wb") as file:
+                while True:
+                    chunk = await loop.run_in_executor(executor, read_chunk, file)
+                    if not chunk:
+                        break
+                    yield chunk
+            completed = True
+        finally:
+            stream.close()
+            if completed:
+                loop.run_in_executor(executor, audio_cache.commit, self.key, tmp_path)
+            else:
+                os.remove(tmp_path)
+
+    async def audio(self) -> bytes:
+        """Whole synthesis as bytes, from the cache when possible"""
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(executor, audio_cache.lookup, self.key)
+        if path is not None:
+            with open(path, "rb") as file:
+                return await loop.run_in_executor(executor, file.read)
+        return b"".join([chunk async for chunk in self.stream()])
+
+    async def respond(self, request: Request) -> StreamResponse:
+        """Serves the cached file when there is one, otherwise streams the synthesis"""
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(executor, audio_cache.lookup, self.key)
+        if path is not None:
+            return FileResponse(path, headers={"Content-Type": "application/octet-stream"})
+        response = StreamResponse(headers={"Content-Type": "application/octet-stream"})
+        await response.prepare(request)
+        async for chunk in self.stream():
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
     @asyncify
     def get_audio(self):
         byte_stream = BytesIO()
@@ -105,3 +255,56 @@ class Polly(BaseModel):
             byte_stream.write(stream.read())
         byte_stream.seek(0)
         return byte_stream
+
+
+async def sentences(deltas: AsyncIterable[str]) -> AsyncGenerator[str, None]:
+    """Regroups streamed text deltas into complete sentences"""
+    buffer = ""
+    async for delta in deltas:
+        buffer += delta
+        *complete, buffer = SENTENCE_END.split(buffer)
+        for sentence in complete:
+            if sentence.strip():
+                yield sentence.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def synthesize_pipeline(
+    texts: AsyncIterable[str], workers: int = env.POLLY_PIPELINE_WORKERS
+) -> AsyncGenerator[bytes, None]:
+    """Synthesizes up to `workers` sentences at once and yields the audio in sentence order"""
+    semaphore = asyncio.Semaphore(workers)
+    pending: "asyncio.Queue[Optional[asyncio.Task]]" = asyncio.Queue(maxsize=workers * 2)
+
+    async def synthesize(text: str) -> bytes:
+        async with semaphore:
+            return await Polly.from_text(text).audio()
+
+    async def produce():
+        try:
+            async for text in texts:
+                await pending.put(asyncio.create_task(synthesize(text)))
+        finally:
+            await pending.put(None)
+
+    producer = asyncio.create_task(produce())
+    started = time.perf_counter()
+    first = True
+    try:
+        while True:
+            task = await pending.get()
+            if task is None:
+                break
+            audio = await task
+            if first:
+                metrics.observe("polly.pipeline.first_audio", time.perf_counter() - started)
+                first = False
+            yield audio
+        await producer
+    finally:
+        producer.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
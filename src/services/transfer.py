@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, BinaryIO, Dict, List, Optional
+
+from aiofauna.utils import setup_logging
+from aiohttp import ClientSession
+from boto3 import Session
+from botocore.exceptions import ClientError
+
+from ..config import credentials, env
+from ..helpers.metrics import metrics
+
+logger = setup_logging(__name__)
+
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+
+def public_url(bucket: str, key: str) -> str:
+    return f"https://s3.amazonaws.com/{bucket}/{key}"
+
+
+class S3Transfer(object):
+    """Uploads to S3 without blocking the event loop.
+
+    boto3 calls run on a dedicated thread pool. A body that fills more than one part goes up as a multipart
+    upload while it is still being read, holding at most `max_parts` part buffers at once.
+    """
+
+    def __init__(self, part_size: int = 8 * 1024 * 1024, max_parts: int = 4, threads: int = 8, region: str = "us-east-1"):
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_parts = max_parts
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="s3")
+        self.client = Session(**credentials).client("s3", region_name=region)
+        self.transfers = 0
+        self.failures = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.in_flight = 0
+
+    async def call(self, method: str, **kwargs: Any) -> Dict[str, Any]:
+        """Runs a boto3 client method on the transfer pool"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(getattr(self.client, method), **kwargs)
+            )
+        finally:
+            metrics.observe(f"s3.{method}", time.perf_counter() - started)
+
+    async def upload(self, bucket: str, key: str, chunks: AsyncIterator[bytes], **extra: Any) -> int:
+        """Streams `chunks` to `bucket/key` and returns the number of bytes written.
+
+        `extra` holds put_object arguments such as ACL and ContentType.
+        """
+        started = time.perf_counter()
+        buffer = bytearray()
+        size = 0
+        upload_id: Optional[str] = None
+        parts: List[Dict[str, Any]] = []
+        sending: List["asyncio.Future[None]"] = []
+        slots = asyncio.Semaphore(self.max_parts)
+
+        async def send(number: int, body: bytes):
+            try:
+                response = await self.call(
+                    "upload_part", Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+                )
+                parts.append({"PartNumber": number, "ETag": response["ETag"]})
+            finally:
+                slots.release()
+
+        async def flush(body: bytes):
+            # Waiting for a free slot stops the reading, which bounds the buffered parts
+            await slots.acquire()
+            for task in sending:
+                if task.done() and task.exception() is not None:
+                    slots.release()
+                    raise task.exception()  # type: ignore
+            sending.append(asyncio.ensure_future(send(len(sending) + 1, body)))
+
+        self.in_flight += 1
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        response = await self.call("create_multipart_upload", Bucket=bucket, Key=key, **extra)
+                        upload_id = response["UploadId"]
+                    body = bytes(buffer[: self.part_size])
+                    del buffer[: self.part_size]
+                    await flush(body)
+            if upload_id is None:
+                await self.call("put_object", Bucket=bucket, Key=key, Body=bytes(buffer), **extra)
+            else:
+                if buffer:
+                    await flush(bytes(buffer))
+                await asyncio.gather(*sending)
+                await self.call(
+                    "complete_multipart_upload",
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])},
+                )
+        except BaseException:
+            self.failures += 1
+            metrics.incr("s3.failed")
+            for task in sending:
+                task.cancel()
+            await asyncio.gather(*sending, return_exceptions=True)
+            if upload_id is not None:
+                await self.abort(bucket, key, upload_id)
+            raise
+        finally:
+            self.in_flight -= 1
+        self.record(size, time.perf_counter() - started)
+        return size
+
+    async def abort(self, bucket: str, key: str, upload_id: str):
+        try:
+            await self.call("abort_multipart_upload", Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error(f"Could not abort the multipart upload of {bucket}/{key}: {exc}")
+
+    async def put(self, bucket: str, key: str, body: bytes, **extra: Any) -> int:
+        """Uploads a body that is already in memory"""
+        started = time.perf_counter()
+        self.in_flight += 1
+        try:
+            await self.call("put_object", Bucket=bucket, Key=key, Body=body, **extra)
+        except Exception:
+            self.failures += 1
+            metrics.incr("s3.failed")
+            raise
+        finally:
+            self.in_flight -= 1
+        self.record(len(body), time.perf_counter() - started)
+        return len(body)
+
+    async def upload_url(self, url: str, bucket: str, key: str, **extra: Any) -> int:
+        """Streams the download of `url` into `bucket/key`"""
+        async with ClientSession() as http:
+            async with http.get(url) as response:
+                response.raise_for_status()
+                return await self.upload(bucket, key, response.content.iter_chunked(CHUNK_SIZE), **extra)
+
+    async def upload_file(self, bucket: str, key: str, file: BinaryIO, **extra: Any) -> int:
+        """Streams a file object into `bucket/key`, reading it on the transfer pool"""
+        return await self.upload(bucket, key, self.read(file), **extra)
+
+    async def read(self, file: BinaryIO) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(self.executor, file.read, self.part_size)
+            if not chunk:
+                return
+            yield chunk
+
+    async def head(self, bucket: str, key: str) -> Optional[Dict[str, Any]]:
+        """Object metadata, None when the object does not exist"""
+        try:
+            return await self.call("head_object", Bucket=bucket, Key=key)
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def presign_put(self, bucket: str, key: str, content_type: str, checksum: str, expires: int = 3600) -> str:
+        """URL the client PUTs the body to, S3 rejects a body whose SHA-256 is not `checksum`"""
+        return self.client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": bucket,
+                "Key": key,
+                "ACL": "public-read",
+                "ContentType": content_type,
+                "ChecksumSHA256": checksum,
+            },
+            ExpiresIn=expires,
+        )
+
+    def presign_post(self, bucket: str, key: str, content_type: str, checksum: str, size: int, expires: int = 3600) -> Dict[str, Any]:
+        """URL and form fields for a browser form upload of exactly `size` bytes"""
+        fields = {"acl": "public-read", "Content-Type": content_type, "x-amz-checksum-sha256": checksum}
+        return self.client.generate_presigned_post(
+            bucket,
+            key,
+            Fields=fields,
+            Conditions=[*({name: value} for name, value in fields.items()), ["content-length-range", size, size]],
+            ExpiresIn=expires,
+        )
+
+    def record(self, size: int, elapsed: float):
+        self.transfers += 1
+        self.bytes += size
+        self.seconds += elapsed
+        metrics.incr("s3.bytes", size)
+        metrics.observe("s3.upload", elapsed)
+        if elapsed > 0:
+            metrics.gauge("s3.throughput", size / elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "transfers": self.transfers,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "bytes": self.bytes,
+            "throughput": self.bytes / self.seconds if self.seconds else 0.0,
+        }
+
+
+transfers = S3Transfer(
+    part_size=env.S3_PART_SIZE, max_parts=env.S3_MAX_PARTS, threads=env.S3_THREADS
+)
@@ -5,10 +5,12 @@ from aiofauna import *
 from aiofauna.llm.llm import *
 from pydantic import BaseModel, Field
 
+from ..helpers.llm import LLM
+
 Size = Literal["256x256", "512x512", "1024x1024"]
 Format = Literal["url", "b64_json"]
 
-llm = LLMStack()
+llm = LLM()
 
 
 class CreateImageResponse(BaseModel):
@@ -28,7 +30,7 @@ class CreateImageRequest(BaseModel):
     response_format: Format = Field(default="url")
 
     async def run(self):
-        response = openai.Image.create(
+        response = await openai.Image.acreate(
             **self.dict(exclude_none=True, exclude={"response_format"})
         )
         assert isinstance(response, dict)
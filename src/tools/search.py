@@ -6,6 +6,8 @@ from aiofauna.llm.llm import *
 from aiohttp import ClientSession
 from bs4 import BeautifulSoup
 
+from ..helpers.singleflight import coalesce
+
 
 class SearchResult(BaseModel):
     title: str = Field(...)
@@ -17,6 +19,7 @@ BROWSER_HEADERS = {
 }
 
 
+@coalesce("search_google")
 async def search_google(
     text: str, lang: str = "en", limit: int = 10
 ) -> List[SearchResult]:
@@ -2,7 +2,7 @@ import asyncio
 from typing import List, Optional
 
 from aiofauna.llm.llm import *
-from aiofauna.llm.llm import LLMStack, UpsertRequest, UpsertVector
+from aiofauna.llm.llm import UpsertRequest, UpsertVector
 from aiofauna.typedefs import FunctionType
 from aiofauna.utils import handle_errors, setup_logging
 from aiohttp import ClientSession, TCPConnector
@@ -11,6 +11,8 @@ from langchain.embeddings import OpenAIEmbeddings
 from pydantic import Field, HttpUrl
 
 from ..config import env
+from ..helpers.background import report_progress, task
+from ..helpers.llm import LLM
 
 openai_embeddings = OpenAIEmbeddings()  # type: ignore
 
@@ -125,7 +127,7 @@ async def sitemap_pipeline(
             continue
 
 
-llm = LLMStack(base_url=PINECONE_URL, headers={"api-key": PINECONE_API_KEY})
+llm = LLM(base_url=PINECONE_URL, headers={"api-key": PINECONE_API_KEY})
 
 
 class IngestSiteMap(FunctionType):
@@ -143,17 +145,24 @@ class IngestSiteMap(FunctionType):
 
     @handle_errors
     async def run(self):
-        async with ClientSession(headers=HEADERS) as session:
-            progress = []
-            async with ClientSession(
-                base_url=env.PINECONE_API_URL, headers={"api-key": env.PINECONE_API_KEY}
-            ) as pinecone:
-                async for data in sitemap_pipeline(
-                    url=self.url,
-                    namespace=self.namespace,
-                    session=session,
-                    pinecone_session=pinecone,
-                ):
-                    progress.append(data)
-                    if data == "100":
-                        break
+        """Starts the ingestion job and returns its id, progress is reported at /api/jobs/{id}"""
+        job = await ingest_sitemap(str(self.url), self.namespace)
+        return {"job": job, "status": f"/api/jobs/{job}"}
+
+
+@task(retries=0, timeout=env.JOB_INGEST_TIMEOUT)
+async def ingest_sitemap(url: str, namespace: str):
+    """Ingests every page of the sitemap, reporting the progress of each upserted chunk"""
+    async with ClientSession(headers=HEADERS) as session:
+        async with ClientSession(
+            base_url=env.PINECONE_API_URL, headers={"api-key": env.PINECONE_API_KEY}
+        ) as pinecone:
+            async for data in sitemap_pipeline(
+                url=url,
+                namespace=namespace,
+                session=session,
+                pinecone_session=pinecone,
+            ):
+                await report_progress(float(data) / 100, f"Ingested {data}% of {url}")
+                if data == "100":
+                    break
@@ -6,10 +6,16 @@ import shutil
 import socket
 import subprocess
 import sys
+import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 
+from aiofauna.utils import setup_logging
 from jinja2 import Template
 
+from .config import env
+from .helpers.metrics import metrics
+
 if sys.version_info >= (3, 10):  # pragma: no cover
     from typing import ParamSpec
 else:  # pragma: no cover
@@ -19,12 +25,19 @@ T = typing.TypeVar("T")
 
 P = ParamSpec("P")
 
+logger = setup_logging(__name__)
+
+executor = ThreadPoolExecutor(
+    max_workers=env.BACKGROUND_THREADS, thread_name_prefix="background"
+)
+
 
 async def run_in_threadpool(
     func: typing.Callable[P, T], *args: P.args, **kwargs: P.kwargs
 ) -> T:
+    """Runs blocking work on the dedicated background pool rather than the loop's default executor"""
     _func = functools.partial(func, *args, **kwargs)
-    return await asyncio.to_thread(_func)
+    return await asyncio.get_running_loop().run_in_executor(executor, _func)
 
 
 nginx_template = Template(
@@ -93,6 +106,15 @@ class BackgroundTask:
         self.args = args
         self.kwargs = kwargs
         self.is_async = is_async_callable(func)
+        self.elapsed: typing.Optional[float] = None
+        self.error: typing.Optional[BaseException] = None
+
+    @property
+    def name(self) -> str:
+        func = self.func
+        while isinstance(func, functools.partial):
+            func = func.func
+        return getattr(func, "__name__", type(func).__name__)
 
     async def __call__(self) -> None:
         if self.is_async:
@@ -102,8 +124,24 @@ class BackgroundTask:
 
 
 class BackgroundTasks(BackgroundTask):
-    def __init__(self, tasks: typing.Optional[typing.Sequence[BackgroundTask]] = None):
+    """Runs its tasks one after another, or at most `concurrency` at a time when it is set.
+
+    In concurrent mode a failing or timed out task is logged on its own `error` and does not
+    stop the others. Sync tasks run on the background pool, a timeout stops waiting on them
+    but cannot interrupt the thread.
+    """
+
+    def __init__(
+        self,
+        tasks: typing.Optional[typing.Sequence[BackgroundTask]] = None,
+        concurrency: typing.Optional[int] = None,
+        timeout: typing.Optional[float] = None,
+    ):
+        if concurrency is not None and concurrency < 1:
+            raise ValueError(f"concurrency must be at least 1, got {concurrency}")
         self.tasks = list(tasks) if tasks else []
+        self.concurrency = concurrency
+        self.timeout = timeout
 
     def add_task(
         self, func: typing.Callable[P, typing.Any], *args: P.args, **kwargs: P.kwargs
@@ -111,9 +149,33 @@ class BackgroundTasks(BackgroundTask):
         task = BackgroundTask(func, *args, **kwargs)
         self.tasks.append(task)
 
+    async def _timed(self, task: BackgroundTask) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(task(), self.timeout)
+        finally:
+            task.elapsed = time.perf_counter() - started
+            metrics.observe(f"background.{task.name}", task.elapsed)
+
+    async def _isolated(self, task: BackgroundTask, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            try:
+                await self._timed(task)
+            except Exception as exc:  # pylint: disable=broad-except
+                task.error = exc
+                metrics.incr(f"background.{task.name}.failed")
+                logger.error(f"Background task {task.name} failed after {task.elapsed:.3f}s: {exc!r}")
+
     async def __call__(self) -> None:
-        for task in self.tasks:
-            await task()
+        if self.concurrency is None:
+            for task in self.tasks:
+                await self._timed(task)
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(self._isolated(task, semaphore) for task in self.tasks))
+
+    def timings(self) -> typing.Dict[str, typing.Optional[float]]:
+        return {f"{index}:{task.name}": task.elapsed for index, task in enumerate(self.tasks)}
 
 
 
@@ -0,0 +1,33 @@
+import os
+
+# src.config requires these at import time, the tests never reach the services they point at
+for name in (
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "FAUNA_SECRET",
+    "REDIS_PASSWORD",
+    "OPENAI_API_KEY",
+    "PINECONE_API_KEY",
+    "GH_API_TOKEN",
+    "AWS_S3_BUCKET",
+    "AWS_LAMBDA_ROLE",
+    "AWS_ECR_URL",
+    "GH_CLIENT_ID",
+    "GH_CLIENT_SECRET",
+    "CF_API_KEY",
+    "CF_EMAIL",
+    "CF_ZONE_ID",
+    "CF_ACCOUNT_ID",
+    "PINECONE_KEY",
+    "AUTH0_DOMAIN",
+):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AUTH0_URL", "https://test.auth0.com")
+os.environ.setdefault("REDIS_HOST", "localhost")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379")
+os.environ.setdefault("PINECONE_API_URL", "http://localhost")
+os.environ.setdefault("PINECONE_URL", "http://localhost")
+os.environ.setdefault("IP_ADDR", "127.0.0.1")
+os.environ.setdefault("CLIENT_URL", "http://localhost")
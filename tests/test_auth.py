@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import jwt
+from aiofauna.client import APIException
+from aiohttp import ClientConnectionError
+
+from src.services.auth import AuthClient, users
+
+
+def token(subject: str) -> str:
+    return jwt.encode({"sub": subject}, "secret", algorithm="HS256", headers={"kid": "rotated"})
+
+
+class JwksUnavailableTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        users.clear()
+        self.client = AuthClient(base_url="https://test.auth0.com", headers={})
+        self.user = mock.Mock(name="user")
+        self.client.userinfo = mock.AsyncMock(return_value={"sub": "auth0|1", "name": "Ada"})
+        self.client.sync_user = mock.AsyncMock(return_value=self.user)
+
+    async def test_falls_back_to_userinfo(self):
+        for error in (APIException("502 Bad Gateway"), ClientConnectionError("refused"), asyncio.TimeoutError()):
+            with self.subTest(error=error):
+                users.clear()
+                self.client.jwks_retry_at = 0.0
+                self.client.get = mock.AsyncMock(side_effect=error)
+
+                self.assertIs(await self.client.user_info(token("auth0|1")), self.user)
+                self.client.userinfo.assert_awaited_with(token("auth0|1"))
+
+    async def test_outage_is_not_refetched_on_every_request(self):
+        self.client.get = mock.AsyncMock(side_effect=APIException("502 Bad Gateway"))
+
+        await self.client.user_info(token("auth0|1"))
+        await self.client.user_info(token("auth0|2"))
+
+        self.assertEqual(self.client.get.await_count, 1)
+        self.assertEqual(self.client.userinfo.await_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
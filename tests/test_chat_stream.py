@@ -0,0 +1,75 @@
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import src.routes.chat  # pylint: disable=unused-import
+from src.config import env
+from src.helpers.llm import semantic_cache
+
+chat = sys.modules["src.routes.chat"]
+
+
+def context(title: str, history: str):
+    conversation = SimpleNamespace(title=title, user="user-1", save_turn=mock.AsyncMock())
+    window = [SimpleNamespace(role="user", content=history)]
+    return SimpleNamespace(conversation=conversation, window=lambda: window)
+
+
+class StreamSemanticScopeTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        semantic_cache.partitions.clear()
+        self.contexts = {}
+        self.streamed = []
+
+        async def stream(text: str, namespace: str, **_):
+            self.streamed.append(namespace)
+            yield f"answer for {namespace}"
+
+        patches = [
+            mock.patch.object(env, "SEMANTIC_CACHE_SCOPE", "user"),
+            mock.patch.object(chat.Namespace, "context", new=self.load),
+            mock.patch.object(chat.llm, "create_embeddings", mock.AsyncMock(return_value=[1.0, 0.0, 0.0])),
+            mock.patch.object(chat.llm, "chat_stream_with_context", side_effect=stream),
+            mock.patch.object(chat.sessions, "broadcast", mock.AsyncMock()),
+            # Saved turns are not under test, this keeps token counting from loading an encoding
+            mock.patch.object(chat, "ChatMessage", SimpleNamespace),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def load(self, namespace: str):
+        return self.contexts[namespace]
+
+    def rendered(self, namespace: str) -> str:
+        frames = [
+            call.args[1]
+            for call in chat.sessions.broadcast.await_args_list
+            if call.args[0] == namespace and isinstance(call.args[1], dict) and call.args[1]["type"] == "rendered"
+        ]
+        return frames[-1]["content"]
+
+    async def test_follow_up_is_not_answered_from_another_conversation(self):
+        self.contexts["a"] = context("Trip to Rome", "Should I book the hotel?")
+        self.contexts["b"] = context("Tax return", "Should I file jointly?")
+
+        await chat.handle_chat_stream("yes", "a")
+        await chat.handle_chat_stream("yes", "b")
+
+        self.assertEqual(self.streamed, ["a", "b"])
+        self.assertIn("answer for b", self.rendered("b"))
+
+    async def test_same_history_is_answered_from_the_cache(self):
+        self.contexts["a"] = context("Trip to Rome", "Should I book the hotel?")
+        self.contexts["b"] = context("Trip to Rome", "Should I book the hotel?")
+
+        await chat.handle_chat_stream("yes", "a")
+        await chat.handle_chat_stream("yes", "b")
+
+        self.assertEqual(self.streamed, ["a"])
+        self.assertIn("answer for a", self.rendered("b"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import base64
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from aiofauna import q
+from aiofauna.json import to_json
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+from aiohttp.web_exceptions import HTTPBadRequest
+
+from src.helpers.pagination import decode_cursor, encode_cursor, iterate, page_params, stream_ndjson
+from src.schemas.models import ChatMessage
+
+
+def ref(id: str, collection: str = "chatmessage"):
+    return {"@ref": {"id": id, "collection": {"@ref": {"id": collection, "collection": {"@ref": {"id": "collections"}}}}}}
+
+
+def document(id: str, content: str):
+    return {
+        "ref": ref(id),
+        "ts": 1700000000000000,
+        "data": {"conversation": "c1", "role": "user", "content": content, "tokens": 1},
+    }
+
+
+class StreamNdjsonTest(unittest.IsolatedAsyncioTestCase):
+    async def test_streams_one_line_per_row(self):
+        rows = [
+            {"id": "1", "content": "hello", "created": datetime(2024, 1, 1, tzinfo=timezone.utc)},
+            {"id": "2", "content": "world", "extra": None},
+        ]
+
+        async def handler(request: web.Request):
+            async def produce():
+                for row in rows:
+                    yield row
+
+            return await stream_ndjson(request, produce())
+
+        app = web.Application()
+        app.router.add_get("/rows", handler)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/rows")
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+            lines = (await response.text()).splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["content"], "hello")
+        self.assertEqual(json.loads(lines[1]), {"id": "2", "content": "world", "extra": None})
+
+
+class CursorTest(unittest.IsolatedAsyncioTestCase):
+    def test_cursor_rebuilds_a_ref(self):
+        cursor = encode_cursor([ref("123")])
+        self.assertEqual(json.loads(base64.urlsafe_b64decode(cursor)), {"id": "123"})
+        self.assertEqual(
+            to_json(decode_cursor(ChatMessage, cursor)),
+            to_json([q.ref(q.collection("chatmessage"), "123")]),
+        )
+
+    def test_no_cursor(self):
+        self.assertIsNone(encode_cursor(None))
+        self.assertIsNone(decode_cursor(ChatMessage, ""))
+
+    def test_tampered_cursor_is_a_bad_request(self):
+        tampered = [
+            "not base64!",
+            base64.urlsafe_b64encode(b"not json").decode(),
+            base64.urlsafe_b64encode(b"[1]").decode(),
+            base64.urlsafe_b64encode(json.dumps({"id": {"@ref": "x"}}).encode()).decode(),
+            base64.urlsafe_b64encode(json.dumps({"id": "1) or true"}).encode()).decode(),
+        ]
+        for cursor in tampered:
+            with self.subTest(cursor=cursor), self.assertRaises(HTTPBadRequest):
+                decode_cursor(ChatMessage, cursor)
+
+    async def test_iterate_continues_from_the_cursor(self):
+        pages = [
+            {"data": [document("1", "a"), document("2", "b")], "after": [ref("3")]},
+            {"data": [document("3", "c")]},
+        ]
+        queries = []
+
+        async def query(expr):
+            queries.append(json.loads(to_json(expr)))
+            return pages[len(queries) - 1]
+
+        with mock.patch.object(ChatMessage, "q", return_value=query):
+            contents = [
+                message.content
+                async for page in iterate(ChatMessage, page_size=2, conversation="c1")
+                for message in page
+            ]
+
+        self.assertEqual(contents, ["a", "b", "c"])
+        self.assertNotIn("after", queries[0]["collection"])
+        self.assertEqual(
+            queries[1]["collection"]["after"],
+            [{"ref": {"collection": "chatmessage"}, "id": "3"}],
+        )
+
+
+class PageParamsTest(unittest.TestCase):
+    def test_limit_is_validated_and_capped(self):
+        self.assertEqual(page_params(make_mocked_request("GET", "/?limit=20")), ("", 20, "json"))
+        self.assertEqual(page_params(make_mocked_request("GET", "/?limit=100000"))[1], 500)
+        for limit in ("abc", "-1"):
+            with self.subTest(limit=limit), self.assertRaises(HTTPBadRequest):
+                page_params(make_mocked_request("GET", f"/?limit={limit}"))
+
+
+if __name__ == "__main__":
+    unittest.main()